@@ -1,10 +1,17 @@
 import argparse
+import glob
+import json
 import os
+import sys
 import numpy as np
 import polars as pl
 import matplotlib.pyplot as plt
 from datetime import datetime, timezone
 
+# shared memory mapped reader lives with the rest of the scid tooling
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SierraScidToDatabase'))
+from scid_parsing_uitl import ScidUtility
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -15,6 +22,32 @@ def parse_args():
     parser.add_argument(
         "-n", "--num", type=int, default=None, help="Max number of records to read"
     )
+    parser.add_argument(
+        "--start", type=datetime.fromisoformat, default=None,
+        help="Only read records at or after this time (ISO format, UTC if no offset given)"
+    )
+    parser.add_argument(
+        "--end", type=datetime.fromisoformat, default=None,
+        help="Only read records before this time (ISO format, UTC if no offset given)"
+    )
+    parser.add_argument(
+        "--index", action="store_true",
+        help="Use (and build/extend) the sparse per-minute sidecar index for --start/--end lookups"
+    )
+    parser.add_argument(
+        "--parquet", default=None,
+        help="Convert the file into a Parquet dataset rooted at this directory and exit"
+    )
+    parser.add_argument(
+        "--symbol", default=None, help="Symbol partition for --parquet, defaults to the file name"
+    )
+    parser.add_argument(
+        "--chunk", type=int, default=5_000_000, help="Records per chunk for --parquet"
+    )
+    parser.add_argument(
+        "--trading-day-offset", type=int, default=0,
+        help="Hours added to UTC before taking the trading date for --parquet partitions"
+    )
     parser.add_argument(
         "--plot", action="store_true", help="Generate price plots"
     )
@@ -32,6 +65,8 @@ def parse_args():
     # Validate arguments
     if not args.show_epochs and not args.input:
         parser.error("--input is required unless using --show-epochs")
+    if (args.start or args.end) and (args.skip or args.num):
+        parser.error("--start/--end can't be combined with --skip/--num")
     
     return args
 
@@ -140,18 +175,36 @@ def calc_offset(file_path, records_to_skip):
 
 
 def read_tick_data(file_path, records_to_skip=0, max_records=None):
-    """Read tick data from binary file and return numpy array"""
+    """
+    Memory map tick data from binary file and return numpy array
+
+    Nothing is copied into RAM until a column is actually used, and a partial
+    record at the end of a file SC is still writing to is ignored
+    """
     _, _, dtypes = get_file_specs(file_path)
     bytes_offset = calc_offset(file_path, records_to_skip)
     
-    if max_records:
-        data = np.fromfile(file_path, dtype=dtypes, offset=bytes_offset, count=max_records)
-    else:
-        data = np.fromfile(file_path, dtype=dtypes, offset=bytes_offset)
+    data, _ = ScidUtility.memmap_records(file_path, offset=bytes_offset, max_records=max_records or None, dtype=dtypes)
     
     return data
 
 
+def read_tick_data_range(file_path, start=None, end=None, epoch_date="1899-12-30", use_index=False):
+    """
+    Read the records with start <= time < end by binary searching the datetime field on disk
+
+    Only the byte span covering the window is mapped, so pulling one session out
+    of years of ticks doesn't scan the file. With use_index the sparse per-minute
+    sidecar index narrows the search further on repeated queries
+    """
+    _, _, dtypes = get_file_specs(file_path)
+    epoch = datetime.strptime(epoch_date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
+    data, _ = ScidUtility.read_time_range(file_path, start, end, use_index=use_index, dtype=dtypes, epoch=epoch)
+
+    return data
+
+
 def process_timestamps(timestamp_col, epoch_offset_us=0):
     """
     Process SC datetime format where last 3 digits are trade counter
@@ -164,11 +217,16 @@ def process_timestamps(timestamp_col, epoch_offset_us=0):
         tuple of (unix_timestamp_us, trade_counter)
     """
     # More efficient than string operations: use integer arithmetic
-    actual_timestamp_us = timestamp_col // 1000  # Remove last 3 digits (trade counter)
-    trade_counter = timestamp_col % 1000         # Get last 3 digits
+    # SC datetimes fit in int64, so reinterpret instead of converting (no copy)
+    timestamp_col = np.asarray(timestamp_col).view(np.int64)
+    
+    # Get last 3 digits, cast straight into the uint16 output instead of keeping an int64 intermediate
+    trade_counter = np.remainder(timestamp_col, 1000, out=np.empty(len(timestamp_col), dtype=np.uint16), casting='unsafe')
     
-    # Convert to Unix epoch by adding the offset
-    unix_timestamp_us = actual_timestamp_us + epoch_offset_us
+    # Zero last 3 digits (still in microseconds) and convert to Unix epoch in place,
+    # the offset is how far the custom epoch sits before 1970-01-01
+    unix_timestamp_us = np.subtract(timestamp_col, trade_counter, dtype=np.int64)
+    unix_timestamp_us -= epoch_offset_us
     
     return unix_timestamp_us, trade_counter
 
@@ -177,33 +235,170 @@ def numpy_to_polars(data, file_type, epoch_offset_us=0):
     """
     Convert numpy structured array to Polars DataFrame with proper timestamp handling
     
+    Each field of the structured array is strided, so every column gets made contiguous
+    exactly once and handed to Polars as is (contiguous numpy arrays are wrapped, not copied)
+    
     Args:
         data: Numpy structured array
         file_type: 'scid' or 'depth'
         epoch_offset_us: Offset to convert from custom epoch to Unix epoch
     """
-    
-    # Convert to dictionary for Polars
-    data_dict = {name: data[name] for name in data.dtype.names}
+    columns = [
+        pl.Series(name, np.ascontiguousarray(data[name]))
+        for name in data.dtype.names if name != 'time'
+    ]
     
     # Process timestamps with custom epoch
-    unix_timestamp_us, trade_counter = process_timestamps(data_dict['time'], epoch_offset_us)
+    unix_timestamp_us, trade_counter = process_timestamps(data['time'], epoch_offset_us)
+    
+    # Replace raw timestamp with processed components, the datetime column is a
+    # datetime64[us] view of the same buffer as timestamp_us
+    columns.append(pl.Series('timestamp_us', unix_timestamp_us))
+    columns.append(pl.Series('trade_counter', trade_counter))
+    columns.append(pl.Series('datetime', unix_timestamp_us.view('datetime64[us]')))
+    
+    return pl.DataFrame(columns)
+
+
+def load_parquet_progress(symbol_dir):
+    """Load how many records of the source file have already been converted"""
+    progress_path = os.path.join(symbol_dir, "_progress.json")
+    if not os.path.exists(progress_path):
+        return {"records_converted": 0}
+    
+    with open(progress_path) as f:
+        return json.load(f)
+
+
+def save_parquet_progress(symbol_dir, progress):
+    """Atomically save the conversion progress so a crash can't leave a half written file"""
+    progress_path = os.path.join(symbol_dir, "_progress.json")
+    tmp_path = f"{progress_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(progress, f, indent=4)
+    os.replace(tmp_path, progress_path)
+
+
+def source_fingerprint(file_path):
+    """
+    What identifies a source file across runs: its path, its size and its first record
+    SC only ever appends, so the same file keeps its first record and never gets smaller
+    """
+    header_size, record_size, _ = get_file_specs(file_path)
+    with open(file_path, "rb") as f:
+        f.seek(header_size)
+        first_record = f.read(record_size)
+    
+    return {
+        "source": os.path.abspath(file_path),
+        "source_size": os.path.getsize(file_path),
+        "first_record": first_record.hex(),
+    }
+
+
+def check_parquet_source(progress, fingerprint, symbol_dir):
+    """Raise if the saved progress belongs to a different (or rotated/truncated) source file than this one"""
+    if not progress["records_converted"]:
+        return
     
-    # Replace raw timestamp with processed components
-    data_dict['timestamp_us'] = unix_timestamp_us
-    data_dict['trade_counter'] = trade_counter
-    data_dict.pop('time')  # Remove original time column
+    problems = []
+    if "source" in progress and os.path.abspath(progress["source"]) != fingerprint["source"]:
+        problems.append(f"it was converted from {progress['source']}")
+    if "first_record" in progress and progress["first_record"] != fingerprint["first_record"]:
+        problems.append("the file starts with a different record")
+    if fingerprint["source_size"] < progress.get("source_size", 0):
+        problems.append(f"the file shrank from {progress['source_size']:,} to {fingerprint['source_size']:,} bytes")
     
-    # Create Polars DataFrame
-    df = pl.DataFrame(data_dict)
+    if problems:
+        raise ValueError(
+            f"{symbol_dir} doesn't match {fingerprint['source']} ({', '.join(problems)}), "
+            f"delete the folder to convert it from scratch or pass a different symbol"
+        )
+
+
+def remove_unsaved_parts(symbol_dir, records_converted):
+    """
+    Delete the part files of a chunk that was written but never checkpointed (the run stopped in between)
+    Parts are named after their first record, so anything at or past the checkpoint is one of them, and the
+    resumed run writes those records again, however it chunks them
+    """
+    for path in glob.glob(os.path.join(symbol_dir, "date=*", "part-*.parquet*")):
+        first_record = os.path.basename(path)[len("part-"):].split(".", 1)[0]
+        if first_record.isdigit() and int(first_record) >= records_converted:
+            os.remove(path)
+
+
+def convert_to_parquet(file_path, output_dir, symbol=None, chunk_records=5_000_000, epoch_offset_us=0,
+                       trading_day_offset_hours=0, compression="zstd", row_group_size=1_000_000):
+    """
+    Stream a .scid/.depth file into a Parquet dataset partitioned by symbol and trading date
+    
+    Layout: output_dir/symbol=ES/date=2024-06-03/part-<first record>.parquet
+    Read it back with pl.scan_parquet(f"{output_dir}/**/*.parquet", hive_partitioning=True),
+    the glob skips the _progress.json kept in each symbol folder
     
-    # Convert timestamp to datetime (now properly using Unix epoch)
-    df = df.with_columns([
-        pl.from_epoch(pl.col('timestamp_us'), time_unit='ms').alias('datetime'),
-        pl.col('trade_counter').cast(pl.UInt16)  # Trade counter as small int
-    ])
+    Args:
+        file_path: .scid or .depth file
+        output_dir: Root of the Parquet dataset
+        symbol: Partition name, defaults to the file name
+        chunk_records: Records read (and held in memory) at a time
+        epoch_offset_us: Offset to convert from custom epoch to Unix epoch
+        trading_day_offset_hours: Hours added to UTC before taking the date, e.g. 7 makes a 17:00 UTC
+            session open count towards the next day
+        compression: Parquet compression codec
+        row_group_size: Rows per row group, each with min/max statistics for pruning
     
-    return df
+    Returns:
+        Number of records converted on this run
+    
+    Progress is saved per symbol after each chunk, so re-running only converts records appended since,
+    parts from a chunk that was written but not saved are deleted and redone
+    Resuming from a different or rotated source file raises ValueError instead of picking up at the old offset
+    """
+    symbol = symbol or os.path.splitext(os.path.basename(file_path))[0]
+    file_type = "scid" if file_path.endswith(".scid") else "depth"
+    symbol_dir = os.path.join(output_dir, f"symbol={symbol}")
+    os.makedirs(symbol_dir, exist_ok=True)
+    
+    progress = load_parquet_progress(symbol_dir)
+    fingerprint = source_fingerprint(file_path)
+    check_parquet_source(progress, fingerprint, symbol_dir)
+    remove_unsaved_parts(symbol_dir, progress["records_converted"])
+    converted = 0
+    
+    while True:
+        data = read_tick_data(file_path, records_to_skip=progress["records_converted"], max_records=chunk_records)
+        if len(data) == 0:
+            break
+        
+        df = numpy_to_polars(data, file_type, epoch_offset_us)
+        df = df.with_columns(
+            (pl.col("datetime") + pl.duration(hours=trading_day_offset_hours)).dt.date().alias("trading_date")
+        )
+        
+        # files are named after their first record, a chunk that never got checkpointed is removed on the next run
+        # (see remove_unsaved_parts) and each file is written under a temp name first so a half written one never shows
+        part_name = f"part-{progress['records_converted']:012d}.parquet"
+        for date_df in df.partition_by("trading_date", maintain_order=True):
+            date_dir = os.path.join(symbol_dir, f"date={date_df['trading_date'][0]}")
+            os.makedirs(date_dir, exist_ok=True)
+            part_path = os.path.join(date_dir, part_name)
+            date_df.drop("trading_date").write_parquet(
+                f"{part_path}.tmp",
+                compression=compression,
+                statistics=True,
+                row_group_size=row_group_size,
+            )
+            os.replace(f"{part_path}.tmp", part_path)
+        
+        progress["records_converted"] += len(data)
+        progress.update(fingerprint)
+        progress["source_size"] = max(fingerprint["source_size"], calc_offset(file_path, progress["records_converted"]))
+        save_parquet_progress(symbol_dir, progress)
+        converted += len(data)
+        print(f"Converted {progress['records_converted']:,} records of {symbol}")
+    
+    return converted
 
 
 def analyze_scid_data(df):
@@ -279,8 +474,19 @@ def main(args):
         print(f"Using custom epoch: {args.epoch}")
         print(f"Epoch offset: {epoch_offset_us:,} microseconds ({epoch_offset_us/1e6/86400:.1f} days)")
         
+        if args.parquet:
+            converted = convert_to_parquet(
+                args.input, args.parquet, symbol=args.symbol, chunk_records=args.chunk,
+                epoch_offset_us=epoch_offset_us, trading_day_offset_hours=args.trading_day_offset,
+            )
+            print(f"Converted {converted:,} new records to {args.parquet}")
+            return
+        
         # Read binary data
-        data = read_tick_data(args.input, records_to_skip=args.skip, max_records=args.num)
+        if args.start or args.end:
+            data = read_tick_data_range(args.input, args.start, args.end, args.epoch, use_index=args.index)
+        else:
+            data = read_tick_data(args.input, records_to_skip=args.skip, max_records=args.num)
         print(f"Read {len(data)} records")
         
         if len(data) == 0:
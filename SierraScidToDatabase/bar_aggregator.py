@@ -0,0 +1,263 @@
+"""
+Incrementally maintained bar tables (bars_1m, bars_5m) built from raw_contracts
+
+Statement level triggers on raw_contracts queue the (contract, minute) bucket of every inserted or updated tick
+in bar_dirty_buckets, in the same transaction as the tick, so a bucket is only queued once its ticks are committed
+however long the writing transaction took. That covers the server's upserts, load_data_to_db's COPY and a
+re-sent tick that changes an existing row (ON CONFLICT DO UPDATE fires the update trigger)
+Every run takes queued buckets off bar_dirty_buckets and recomputes just those from all of their ticks, in one
+transaction with the bars, the wider bars are rolled up from bars_1m, so nothing but the touched minutes is ever
+read back from raw_contracts
+Deleting raw rows doesn't touch the bars, and the bucketing uses date_bin (Postgres 14+)
+
+e.g. python bar_aggregator.py --interval 5   (keep the bars up to date every 5 seconds)
+"""
+import io
+import os
+import time
+import argparse
+import logging
+import polars as pl
+from database_util import DatabaseUtility
+from dotenv import load_dotenv
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('bar_aggregator')
+
+# bar table -> bar length, the first one is built from raw_contracts and the others from it
+BAR_TABLES = {
+    "bars_1m": "1 minute",
+    "bars_5m": "5 minutes",
+}
+BASE_TABLE = next(iter(BAR_TABLES))
+
+# queued buckets handled per transaction
+MAX_BUCKETS_PER_RUN = 50_000
+
+BAR_COLUMNS = ("contract_id", "symbol", "bucket", "open", "high", "low", "close", "volume", "bid_volume", "ask_volume",
+               "num_trades", "num_ticks")
+READ_SCHEMA = {
+    "contract_id": pl.Utf8, "symbol": pl.Utf8, "bucket": pl.Utf8, "open": pl.Float64, "high": pl.Float64,
+    "low": pl.Float64, "close": pl.Float64, "volume": pl.Int64, "bid_volume": pl.Int64, "ask_volume": pl.Int64,
+    "num_trades": pl.Int64, "num_ticks": pl.Int64,
+}
+
+
+class BarAggregator:
+
+    @classmethod
+    def create_tables(cls, conn) -> None:
+        """
+        This function creates the bar tables, the bucket queue and the triggers on raw_contracts that fill it
+        The first time the triggers go in, every bucket already in raw_contracts is queued so the next run builds them
+        """
+        with conn.cursor() as cur:
+            for table_name in BAR_TABLES:
+                cur.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {table_name} (
+                        contract_id VARCHAR(50) NOT NULL,
+                        symbol VARCHAR(20) NOT NULL,
+                        bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+                        open DECIMAL(12, 6),
+                        high DECIMAL(12, 6),
+                        low DECIMAL(12, 6),
+                        close DECIMAL(12, 6),
+                        volume BIGINT,
+                        bid_volume BIGINT,
+                        ask_volume BIGINT,
+                        num_trades BIGINT,
+                        num_ticks INTEGER,
+                        PRIMARY KEY (contract_id, bucket)
+                    );
+                """)
+                cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_symbol ON {table_name}(symbol, bucket);")
+
+            # no key on purpose, writers touching the same bucket never wait on each other, runs dedupe
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS bar_dirty_buckets (
+                    id BIGSERIAL PRIMARY KEY,
+                    contract_id VARCHAR(50) NOT NULL,
+                    bucket TIMESTAMP WITH TIME ZONE NOT NULL
+                );
+            """)
+
+            cur.execute(f"""
+                CREATE OR REPLACE FUNCTION queue_bar_buckets() RETURNS trigger LANGUAGE plpgsql AS $$
+                BEGIN
+                    INSERT INTO bar_dirty_buckets (contract_id, bucket)
+                    SELECT DISTINCT contract_id, date_bin('{BAR_TABLES[BASE_TABLE]}'::interval, datetime, timestamptz 'epoch')
+                    FROM new_rows;
+                    RETURN NULL;
+                END
+                $$;
+            """)
+
+            # a trigger with transition tables can only have one event, so one each for INSERT and UPDATE
+            cur.execute("SELECT count(*) FROM pg_trigger WHERE tgrelid = 'raw_contracts'::regclass AND tgname LIKE 'queue_bar_buckets_%'")
+            if cur.fetchone()[0] < 2:
+                for event in ("insert", "update"):
+                    cur.execute(f"""
+                        CREATE OR REPLACE TRIGGER queue_bar_buckets_{event} AFTER {event.upper()} ON raw_contracts
+                        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION queue_bar_buckets()
+                    """)
+                cur.execute(f"""
+                    INSERT INTO bar_dirty_buckets (contract_id, bucket)
+                    SELECT DISTINCT contract_id, date_bin('{BAR_TABLES[BASE_TABLE]}'::interval, datetime, timestamptz 'epoch')
+                    FROM raw_contracts
+                """)
+                logger.info(f"Installed the bar triggers on raw_contracts, queued {cur.rowcount:,} existing buckets")
+        conn.commit()
+
+    @classmethod
+    def update_bars(cls, conn, max_buckets: int = MAX_BUCKETS_PER_RUN) -> dict:
+        """
+        This function takes up to max_buckets queued buckets off bar_dirty_buckets and rebuilds them in the bar tables,
+        all in one transaction, so a failed run leaves them queued
+        Returns how many queue entries it took and how many bars each table got, call it again while "caught_up" is False
+        Buckets another run is working on are skipped, so several aggregators can run at once
+        """
+        with conn.cursor() as cur:
+            # the base buckets to rebuild, only committed ticks can have queued them
+            cur.execute("""
+                CREATE TEMP TABLE touched_buckets ON COMMIT DROP AS
+                WITH taken AS (
+                    DELETE FROM bar_dirty_buckets
+                    WHERE id IN (SELECT id FROM bar_dirty_buckets ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED)
+                    RETURNING contract_id, bucket
+                )
+                SELECT contract_id, bucket, count(*) AS entries FROM taken GROUP BY contract_id, bucket
+            """, (max_buckets,))
+            # the queue holds a bucket once per statement that touched it, so count what was deleted, not the buckets
+            cur.execute("SELECT COALESCE(sum(entries), 0)::bigint FROM touched_buckets")
+            taken = cur.fetchone()[0]
+            result = {"queued": taken, "caught_up": taken < max_buckets, "bars": {}}
+
+            if not taken:
+                conn.rollback()
+                return result
+
+            # rebuild those buckets from their ticks, LATERAL makes it one (contract_id, datetime) index range scan
+            # per bucket, a plain join on the range ends up comparing every tick of a contract with every bucket
+            cur.execute(cls._upsert_sql(BASE_TABLE, """
+                SELECT t.contract_id, r.*
+                FROM touched_buckets t
+                CROSS JOIN LATERAL (
+                    SELECT min(symbol), t.bucket,
+                           (array_agg(price ORDER BY datetime))[1], max(price), min(price),
+                           (array_agg(price ORDER BY datetime DESC))[1],
+                           sum(COALESCE(bid_volume, 0) + COALESCE(ask_volume, 0)), sum(bid_volume), sum(ask_volume),
+                           sum(num_trades), count(*) AS num_ticks
+                    FROM raw_contracts
+                    WHERE contract_id = t.contract_id AND datetime >= t.bucket AND datetime < t.bucket + %s::interval
+                ) r
+                WHERE r.num_ticks > 0
+            """), (BAR_TABLES[BASE_TABLE],))
+            result["bars"][BASE_TABLE] = cur.rowcount
+
+            # the wider bars are rebuilt from the base bars they contain
+            for table_name, interval in list(BAR_TABLES.items())[1:]:
+                cur.execute(cls._upsert_sql(table_name, f"""
+                    SELECT w.contract_id, b.*
+                    FROM (
+                        SELECT DISTINCT contract_id, date_bin(%s::interval, bucket, timestamptz 'epoch') AS bucket
+                        FROM touched_buckets
+                    ) w
+                    CROSS JOIN LATERAL (
+                        SELECT min(symbol), w.bucket,
+                               (array_agg(open ORDER BY bucket))[1], max(high), min(low),
+                               (array_agg(close ORDER BY bucket DESC))[1],
+                               sum(volume), sum(bid_volume), sum(ask_volume), sum(num_trades), sum(num_ticks) AS num_ticks
+                        FROM {BASE_TABLE}
+                        WHERE contract_id = w.contract_id AND bucket >= w.bucket AND bucket < w.bucket + %s::interval
+                    ) b
+                    WHERE b.num_ticks > 0
+                """), (interval, interval))
+                result["bars"][table_name] = cur.rowcount
+
+        conn.commit()
+        return result
+
+    @classmethod
+    def catch_up(cls, conn, max_buckets: int = MAX_BUCKETS_PER_RUN) -> int:
+        """
+        This function runs update_bars until the bucket queue is empty, returns the number of bars written
+        """
+        written = 0
+        while True:
+            start = time.perf_counter()
+            result = cls.update_bars(conn, max_buckets)
+            bars = sum(result["bars"].values())
+            written += bars
+            if bars:
+                logger.info(f"{result['queued']:,} queued buckets: {result['bars']} in {time.perf_counter() - start:.2f}s")
+            if result["caught_up"]:
+                return written
+
+    @classmethod
+    def read_bars(cls, conn, table_name, contract_id=None, symbol=None, start=None, end=None) -> pl.DataFrame:
+        """
+        This function reads bars for a contract or symbol (start <= bucket < end) into a polars DataFrame through COPY
+        """
+        if contract_id is not None:
+            conditions, params = ["contract_id = %s"], [contract_id]
+        elif symbol is not None:
+            conditions, params = ["symbol = %s"], [symbol]
+        else:
+            raise ValueError("read_bars needs a contract_id or a symbol")
+        if start is not None:
+            conditions.append("bucket >= %s")
+            params.append(start)
+        if end is not None:
+            conditions.append("bucket < %s")
+            params.append(end)
+
+        with conn.cursor() as cur:
+            query = cur.mogrify(
+                f"SELECT {', '.join(BAR_COLUMNS)} FROM {table_name} WHERE {' AND '.join(conditions)} ORDER BY bucket, contract_id",
+                params
+            ).decode('utf-8')
+            buffer = io.BytesIO()
+            cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv)", buffer)
+
+        buffer.seek(0)
+        frame = (pl.read_csv(buffer, has_header=False, new_columns=list(BAR_COLUMNS), schema=READ_SCHEMA)
+                 if buffer.getbuffer().nbytes else pl.DataFrame(schema=READ_SCHEMA))
+
+        return frame.with_columns(
+            pl.col("bucket").str.to_datetime("%Y-%m-%d %H:%M:%S%.f%#z", time_unit="us").dt.convert_time_zone("UTC")
+        )
+
+    @classmethod
+    def _upsert_sql(cls, table_name, source) -> str:
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in BAR_COLUMNS if column not in ("contract_id", "bucket"))
+        return f"""
+            INSERT INTO {table_name} ({", ".join(BAR_COLUMNS)})
+            {source}
+            ON CONFLICT (contract_id, bucket) DO UPDATE SET {updates}
+        """
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--interval", type=float, default=0, help="Seconds between runs, 0 = catch up once and exit")
+    parser.add_argument("--max-buckets", type=int, default=MAX_BUCKETS_PER_RUN, help="Queued buckets handled per transaction")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    load_dotenv('./keys_and_secrets.env')
+    conn = DatabaseUtility.database_connect(os.getenv('sql_name'), os.getenv('sql_username'), os.getenv('sql_password'))
+    BarAggregator.create_tables(conn)
+
+    while True:
+        BarAggregator.catch_up(conn, args.max_buckets)
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+    conn.close()
@@ -0,0 +1,202 @@
+"""
+Streaming bar builder for SC intraday records
+
+Feed it record batches straight from ScidUtility.parse_scid / follow_scid or tick-data.py's read_tick_data
+and it hands back finished bars, the bar still being built is carried over to the next batch
+"""
+import numpy as np
+from scid_parsing_uitl import ScidUtility
+
+BAR_TYPES = ("time", "tick", "volume", "dollar", "range")
+BAR_COLUMNS = ("datetime", "open", "high", "low", "close", "volume", "bid_volume", "ask_volume", "num_trades")
+
+
+class BarBuilder:
+    """
+    Builds one kind of bar from a stream of .scid records:
+        "time" -> size is the bar length in microseconds (60_000_000 = 1 minute bars)
+        "tick" -> size is the number of trades per bar
+        "volume" -> size is the number of contracts per bar
+        "dollar" -> size is the traded value (price * volume) per bar
+        "range" -> size is the high - low range (in price) that closes a bar
+
+    Tick, volume and dollar bars are cut every size of the running total, a record that crosses a cut
+    stays in the bar it started in, so that bar runs a little over and the next one a little short
+
+    tick_data means the file holds single trades (SC puts the ask/bid in high/low), so only close is used for prices,
+    set it to False for files that store actual bars
+
+    Both .scid dtypes in the repo have the fields in the same order, so fields are picked by position, not name
+    """
+
+    def __init__(self, bar_type: str = "time", size=60_000_000, tick_data: bool = True):
+        if bar_type not in BAR_TYPES:
+            raise ValueError(f"bar_type must be one of {BAR_TYPES}, got {bar_type}")
+
+        self.bar_type = bar_type
+        self.size = size
+        self.tick_data = tick_data
+
+        self._partial = None      # the bar still being built, same layout as the output with one row
+        self._partial_key = None
+        self._cumulative = 0      # running trades/volume/dollars for the threshold bars
+        self._range_key = 0
+        self._range_high = -np.inf
+        self._range_low = np.inf
+
+    def _columns(self, records) -> dict:
+        """
+        Pull the needed fields out of the record batch
+        """
+        names = records.dtype.names
+        close = np.asarray(records[names[4]], dtype=np.float64)
+
+        return {
+            "time": np.asarray(records[names[0]]).view(np.int64),
+            "open": close if self.tick_data else np.asarray(records[names[1]], dtype=np.float64),
+            "high": close if self.tick_data else np.asarray(records[names[2]], dtype=np.float64),
+            "low": close if self.tick_data else np.asarray(records[names[3]], dtype=np.float64),
+            "close": close,
+            "num_trades": np.asarray(records[names[5]], dtype=np.int64),
+            "volume": np.asarray(records[names[6]], dtype=np.int64),
+            "bid_volume": np.asarray(records[names[7]], dtype=np.int64),
+            "ask_volume": np.asarray(records[names[8]], dtype=np.int64),
+        }
+
+    def _threshold_keys(self, amount):
+        """
+        Bar number of every record for tick/volume/dollar bars, a record belongs to the bar the running total was in before it
+        Returns the keys and the key the next record would get
+        """
+        running = np.cumsum(amount) + self._cumulative
+        before = running - amount
+        self._cumulative = running[-1]
+
+        return (before // self.size).astype(np.int64), int(self._cumulative // self.size)
+
+    def _range_keys(self, close):
+        """
+        Bar number of every record for range bars
+        Range bars depend on the path so this walks bar by bar, but each bar is found with a vectorized running max/min
+        over a window that grows until the range is hit
+        Returns the keys and the key the next record would get
+        """
+        keys = np.empty(len(close), dtype=np.int64)
+        i = 0
+
+        while i < len(close):
+            window = 256
+            while True:
+                segment = close[i:i + window]
+                running_high = np.maximum(np.maximum.accumulate(segment), self._range_high)
+                running_low = np.minimum(np.minimum.accumulate(segment), self._range_low)
+                hit = np.flatnonzero(running_high - running_low >= self.size)
+                if len(hit) or i + window >= len(close):
+                    break
+                window *= 4
+
+            if len(hit):
+                end = i + hit[0] + 1
+                keys[i:end] = self._range_key
+                self._range_key += 1
+                self._range_high = -np.inf
+                self._range_low = np.inf
+            else:
+                end = len(close)
+                keys[i:end] = self._range_key
+                self._range_high = running_high[-1]
+                self._range_low = running_low[-1]
+            i = end
+
+        return keys, self._range_key
+
+    def update(self, records) -> dict:
+        """
+        This function adds a batch of records and returns the bars it finished as a dict of columns (BAR_COLUMNS)
+        "datetime" is the bar start (the bucket start for time bars, the first record otherwise) as datetime64[us]
+        """
+        if len(records) == 0:
+            return self._empty_bars()
+
+        columns = self._columns(records)
+
+        if self.bar_type == "time":
+            keys = columns["time"] // self.size
+            next_key = None  # a time bar only closes when a record lands in a later bucket
+        elif self.bar_type == "tick":
+            keys, next_key = self._threshold_keys(columns["num_trades"])
+        elif self.bar_type == "volume":
+            keys, next_key = self._threshold_keys(columns["volume"])
+        elif self.bar_type == "dollar":
+            keys, next_key = self._threshold_keys(columns["close"] * columns["volume"])
+        else:
+            keys, next_key = self._range_keys(columns["close"])
+
+        starts = np.flatnonzero(np.diff(keys, prepend=keys[0] - 1))
+        ends = np.append(starts[1:], len(keys)) - 1
+
+        bars = {
+            "datetime": keys[starts] * self.size if self.bar_type == "time" else columns["time"][starts],
+            "open": columns["open"][starts],
+            "high": np.maximum.reduceat(columns["high"], starts),
+            "low": np.minimum.reduceat(columns["low"], starts),
+            "close": columns["close"][ends],
+        }
+        for name in ("volume", "bid_volume", "ask_volume", "num_trades"):
+            bars[name] = np.add.reduceat(columns[name], starts)
+        bar_keys = keys[starts]
+
+        # fold the carried bar into the first one, or emit it as finished if this batch moved past it
+        if self._partial is not None:
+            if self._partial_key == bar_keys[0]:
+                bars["datetime"][0] = self._partial["datetime"][0]
+                bars["open"][0] = self._partial["open"][0]
+                bars["high"][0] = max(bars["high"][0], self._partial["high"][0])
+                bars["low"][0] = min(bars["low"][0], self._partial["low"][0])
+                for name in ("volume", "bid_volume", "ask_volume", "num_trades"):
+                    bars[name][0] += self._partial[name][0]
+            else:
+                bars = {name: np.concatenate((self._partial[name], bars[name])) for name in bars}
+                bar_keys = np.concatenate(([self._partial_key], bar_keys))
+
+        # the last bar stays open unless the next record is already known to start a new one
+        if next_key is None or next_key == bar_keys[-1]:
+            self._partial = {name: values[-1:].copy() for name, values in bars.items()}
+            self._partial_key = bar_keys[-1]
+            bars = {name: values[:-1] for name, values in bars.items()}
+        else:
+            self._partial = None
+            self._partial_key = None
+
+        return self._finish(bars)
+
+    def flush(self) -> dict:
+        """
+        This function returns the bar still being built (if any) and resets it, use it at the end of a file or session
+        """
+        if self._partial is None:
+            return self._empty_bars()
+
+        bars = self._partial
+        self._partial = None
+        self._partial_key = None
+        self._range_high = -np.inf
+        self._range_low = np.inf
+
+        return self._finish(bars)
+
+    def _finish(self, bars: dict) -> dict:
+        """
+        Turn the raw SC bar times into datetime64[us]
+        """
+        bars = dict(bars)
+        bars["datetime"] = ScidUtility.sc_to_datetime64(bars["datetime"])
+        return bars
+
+    def _empty_bars(self) -> dict:
+        bars = {name: np.empty(0, dtype=np.float64) for name in ("open", "high", "low", "close")}
+        for name in ("volume", "bid_volume", "ask_volume", "num_trades"):
+            bars[name] = np.empty(0, dtype=np.int64)
+        bars["datetime"] = np.empty(0, dtype="datetime64[us]")
+
+        return {name: bars[name] for name in BAR_COLUMNS}
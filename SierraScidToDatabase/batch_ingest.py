@@ -0,0 +1,187 @@
+"""
+Batch ingestion driver for a whole folder of .scid files
+
+Parsing, timestamp decoding and writing the output run in a process pool (one file per task),
+every worker moves its file's checkpoint in the ingest catalog right after each chunk it writes and the parent
+logs each file's run once it finishes, so stopping part way never loses a written chunk's checkpoint
+"""
+import os
+import glob
+import time
+import argparse
+import logging
+import numpy as np
+import polars as pl
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scid_parsing_uitl import ScidUtility
+from ingest_catalog import IngestCatalog
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('batch_ingest')
+
+CHUNK_RECORDS = 5_000_000
+
+
+class BatchIngestor:
+
+    @classmethod
+    def find_scid_files(cls, source: str) -> list:
+        """
+        This function resolves a directory (every .scid file in it) or a glob pattern into a sorted list of .scid files
+        """
+        if os.path.isdir(source):
+            source = os.path.join(source, "*.scid")
+
+        return sorted(path for path in glob.glob(source) if path.endswith(".scid"))
+
+    @classmethod
+    def symbol_from_path(cls, file_path: str) -> str:
+        """
+        Symbol the checkpoints are stored under, SC names the files after the symbol (ESU25-CME.scid -> ESU25-CME)
+        """
+        return os.path.splitext(os.path.basename(file_path))[0]
+
+    @classmethod
+    def ingest_file(cls, file_path: str, offset: int, output_dir: str, chunk_records: int = CHUNK_RECORDS) -> dict:
+        """
+        This function parses everything in a .scid file after the offset, decodes the timestamps and writes it to parquet
+        It runs inside the pool workers, the checkpoint is moved as soon as each chunk's file is written (the catalog
+        takes writes from several processes), and it returns where it got to for the parent's run log
+
+        Records are handled chunk_records at a time (one parquet file per chunk) so memory stays flat on large files
+        """
+        start_time = time.perf_counter()
+        symbol = cls.symbol_from_path(file_path)
+        symbol_dir = os.path.join(output_dir, symbol)
+        os.makedirs(symbol_dir, exist_ok=True)
+
+        position = offset
+        num_records = 0
+        last_timestamp = ""
+
+        while True:
+            records, new_position = ScidUtility.memmap_records(file_path, position, chunk_records)
+            if len(records) == 0:
+                break
+
+            df = pl.DataFrame({
+                "datetime": ScidUtility.sc_to_datetime64(records["scdatetime"]),
+                "open": np.ascontiguousarray(records["open"]),
+                "high": np.ascontiguousarray(records["high"]),
+                "low": np.ascontiguousarray(records["low"]),
+                "close": np.ascontiguousarray(records["close"]),
+                "num_trades": np.ascontiguousarray(records["numtrades"]),
+                "total_volume": np.ascontiguousarray(records["totalvolume"]),
+                "bid_volume": np.ascontiguousarray(records["bidvolume"]),
+                "ask_volume": np.ascontiguousarray(records["askvolume"]),
+            })
+
+            # name the file after the byte span so a rerun after a crash overwrites instead of duplicating
+            df.write_parquet(os.path.join(symbol_dir, f"{symbol}_{position}_{new_position}.parquet"))
+
+            num_records += len(records)
+            last_timestamp = ScidUtility.sc_to_datetime(records["scdatetime"][-1]).isoformat()
+            position = new_position
+            IngestCatalog.update_symbol_checkpoint(symbol, position, last_timestamp, file_path)
+
+        return {
+            "symbol": symbol,
+            "file_path": file_path,
+            "num_records": num_records,
+            "num_bytes": position - offset,
+            "new_position": position,
+            "last_timestamp": last_timestamp,
+            "seconds": time.perf_counter() - start_time,
+        }
+
+    @classmethod
+    def ingest(cls, source: str, output_dir: str, workers: int = None, chunk_records: int = CHUNK_RECORDS) -> list:
+        """
+        This function fans every .scid file matching source out across a process pool
+        Each file starts from its IngestCatalog checkpoint and the checkpoint is moved forward after every chunk written,
+        a file that fails keeps the checkpoint of its last written chunk (the failure is logged in ingest_runs) and
+        carries on from there on the next run
+        Files that haven't changed since their last checkpoint are skipped without being opened
+
+        This function returns the per file stats from ingest_file
+        """
+        files = cls.find_scid_files(source)
+        if not files:
+            logger.warning(f"No .scid files found for {source}")
+            return []
+
+        IngestCatalog.initialize()
+        offsets = {}
+        for file_path in files:
+            symbol = cls.symbol_from_path(file_path)
+            if IngestCatalog.is_unchanged(symbol, file_path):
+                logger.info(f"{symbol}: unchanged since the last run, skipping")
+                continue
+            IngestCatalog.add_symbol_settings(symbol, file_path)
+            offsets[file_path] = IngestCatalog.get_symbol_settings(symbol)["last_parsed_index"]
+
+        results = []
+        futures = {}
+        handled = set()
+        start_time = time.perf_counter()
+
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(cls.ingest_file, file_path, offset, output_dir, chunk_records): file_path
+                    for file_path, offset in offsets.items()
+                }
+
+                for future in as_completed(futures):
+                    handled.add(future)
+                    cls._log_run(future, futures[future], offsets[futures[future]], results)
+        finally:
+            # stopped early (e.g. ctrl+c), the pool has waited for its running files, log the ones that finished
+            for future, file_path in futures.items():
+                if future.done() and future not in handled and not future.cancelled():
+                    cls._log_run(future, file_path, offsets[file_path], results)
+
+        total_records = sum(result["num_records"] for result in results)
+        elapsed = time.perf_counter() - start_time
+        logger.info(f"Ingested {total_records:,} records from {len(results)}/{len(files)} files in {elapsed:.2f}s")
+
+        return results
+
+    @classmethod
+    def _log_run(cls, future, file_path: str, offset: int, results: list) -> None:
+        """ Log a finished file in ingest_runs (its checkpoint is already where ingest_file left it) """
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Failed to ingest {file_path}: {e}")
+            IngestCatalog.record_run(cls.symbol_from_path(file_path), file_path, offset, status="failed", error=str(e))
+            return
+
+        if result["num_records"]:
+            IngestCatalog.record_run(result["symbol"], file_path, offset, result["new_position"], result["num_records"],
+                                     result["num_bytes"], result["seconds"])
+
+        seconds = max(result["seconds"], 1e-9)
+        logger.info(
+            f"{result['symbol']}: {result['num_records']:,} records in {result['seconds']:.2f}s "
+            f"({result['num_records'] / seconds:,.0f} rec/s, {result['num_bytes'] / seconds / 1e6:,.1f} MB/s)"
+        )
+        results.append(result)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="Directory or glob of .scid files (e.g. 'C:/SierraChart/Data/*.scid')")
+    parser.add_argument("-o", "--output", required=True, help="Directory the parquet files get written to")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Number of worker processes, defaults to the cpu count")
+    parser.add_argument("--chunk", type=int, default=CHUNK_RECORDS, help="Records per parquet file")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    BatchIngestor.ingest(args.source, args.output, args.workers, args.chunk)
@@ -0,0 +1,202 @@
+"""
+Builds the continuous_contracts table out of the individual contracts in raw_contracts or .scid files
+
+Every step works on whole arrays: daily volume/open interest per contract is one bincount, the active contract
+per day is an argmax plus a running max (so we never roll back into an older contract), and the back adjustment
+is a reversed cumsum of the roll gaps
+"""
+import io
+import numpy as np
+import polars as pl
+from scid_parsing_uitl import ScidUtility
+from database_util import DatabaseUtility, TABLE_COLUMNS
+
+US_PER_DAY = 86_400 * 1_000_000
+
+
+class ContinuousContractBuilder:
+
+    @classmethod
+    def from_scid_files(cls, contract_files: dict) -> dict:
+        """
+        This function parses {contract_id: path to .scid} into {contract_id: DataFrame} for build
+        """
+        return {
+            contract_id: DatabaseUtility.to_table_frame(ScidUtility.parse_scid(path, 0)[0], "continuous_contracts", contract_id)
+            for contract_id, path in contract_files.items()
+        }
+
+    @classmethod
+    def from_database(cls, conn, symbol: str, start=None, end=None) -> dict:
+        """
+        This function pulls every contract of a symbol out of raw_contracts into {contract_id: DataFrame} for build
+        raw_contracts has no total volume, so bid + ask volume is used
+        """
+        query = """
+            SELECT contract_id, (EXTRACT(EPOCH FROM datetime) * 1000000)::bigint AS datetime,
+                   price::float8 AS price, num_trades, bid_volume, ask_volume
+            FROM raw_contracts
+            WHERE symbol = %s AND datetime >= COALESCE(%s::timestamptz, '-infinity') AND datetime < COALESCE(%s::timestamptz, 'infinity')
+        """
+        cur = conn.cursor()
+        buffer = io.BytesIO()
+        try:
+            cur.copy_expert(f"COPY ({cur.mogrify(query, (symbol, start, end)).decode()}) TO STDOUT WITH (FORMAT csv, HEADER)", buffer)
+        finally:
+            cur.close()
+
+        buffer.seek(0)
+        frame = pl.read_csv(buffer, schema={
+            "contract_id": pl.String,
+            "datetime": pl.Int64,
+            "price": pl.Float64,
+            "num_trades": pl.Int64,
+            "bid_volume": pl.Int64,
+            "ask_volume": pl.Int64,
+        }).with_columns(
+            pl.col("datetime").cast(pl.Datetime("us", "UTC")),
+            (pl.col("bid_volume") + pl.col("ask_volume")).alias("volume"),
+        )
+
+        return {contract_id[0]: contract for contract_id, contract in frame.partition_by("contract_id", as_dict=True).items()}
+
+    @classmethod
+    def build(cls, symbol: str, contracts: dict, rule: str = "volume", open_interest: pl.DataFrame = None,
+              back_adjust: bool = False, day_offset_hours: int = 0) -> pl.DataFrame:
+        """
+        This function stitches the contracts of one symbol into a continuous series
+
+        contracts is {contract_id: DataFrame with datetime, price, volume, num_trades, bid_volume, ask_volume}
+        (what from_scid_files / from_database return), contracts are ordered by their last timestamp (expiry proxy)
+
+        rule picks the active contract per trading day from the previous day's numbers so there's no lookahead:
+            "volume" -> contract with the most volume
+            "open_interest" -> contract with the most open interest, open_interest needs date, contract_id, open_interest columns
+        The active contract can only move forward to a later contract, never back
+
+        rollover_flag is set on the first row of a newly active contract
+        back_adjust shifts every older contract by the gap between the new and old contract's closes the day before each roll,
+        so the latest contract keeps its real prices
+
+        day_offset_hours moves the (UTC) day boundary, e.g. 7 puts the 17:00 UTC session open on the next trading day
+
+        This function returns a DataFrame with the continuous_contracts columns
+        """
+        if rule not in ("volume", "open_interest"):
+            raise ValueError(f"rule must be 'volume' or 'open_interest', got {rule}")
+
+        contract_ids = sorted(contracts, key=lambda contract_id: contracts[contract_id]["datetime"].max())
+        frames = [
+            contracts[contract_id].select(
+                pl.col("datetime").cast(pl.Datetime("us")).dt.replace_time_zone(None).cast(pl.Int64).alias("time"),
+                pl.col("price").cast(pl.Float64),
+                pl.col("volume").cast(pl.Int64),
+                pl.col("num_trades").cast(pl.Int64),
+                pl.col("bid_volume").cast(pl.Int64),
+                pl.col("ask_volume").cast(pl.Int64),
+                pl.lit(code, dtype=pl.Int64).alias("code"),
+            )
+            for code, contract_id in enumerate(contract_ids)
+        ]
+        ticks = pl.concat(frames).sort("time", "code")
+
+        time = ticks["time"].to_numpy()
+        price = ticks["price"].to_numpy()
+        code = ticks["code"].to_numpy()
+        num_contracts = len(contract_ids)
+
+        day = (time + day_offset_hours * 3_600_000_000) // US_PER_DAY
+        first_day = day.min()
+        day_index = day - first_day
+        num_days = int(day_index.max()) + 1
+        cell = day_index * num_contracts + code
+
+        # (day, contract) matrix of whatever the roll rule ranks by
+        if rule == "volume":
+            ranking = np.bincount(cell, weights=ticks["volume"].to_numpy(), minlength=num_days * num_contracts)
+        else:
+            oi = open_interest.filter(pl.col("contract_id").is_in(contract_ids))
+            oi_day = oi["date"].cast(pl.Date).cast(pl.Int64).to_numpy() - first_day
+            oi_code = oi["contract_id"].replace_strict(contract_ids, list(range(num_contracts))).to_numpy()
+            in_range = (oi_day >= 0) & (oi_day < num_days)
+            ranking = np.bincount(oi_day[in_range] * num_contracts + oi_code[in_range],
+                                  weights=oi["open_interest"].to_numpy()[in_range], minlength=num_days * num_contracts)
+        ranking = ranking.reshape(num_days, num_contracts)
+
+        # the leader only ever moves forward, days without data keep the last one,
+        # each day trades the previous day's leader (the first day just uses itself)
+        leader = np.maximum.accumulate(np.where(ranking.sum(axis=1) > 0, ranking.argmax(axis=1), 0))
+        active = np.concatenate((leader[:1], leader[:-1]))
+
+        selected = code == active[day_index]
+        all_price = price
+        time, price, code, day_index = time[selected], price[selected], code[selected], day_index[selected]
+
+        rollover = np.zeros(len(code), dtype=bool)
+        rollover[1:] = code[1:] != code[:-1]
+
+        if back_adjust and rollover.any():
+            # (day, contract) matrix of closes, forward filled so a roll after a weekend/holiday still finds both closes
+            _, first_from_end = np.unique(cell[::-1], return_index=True)
+            last_row = len(cell) - 1 - first_from_end
+            closes = np.full(num_days * num_contracts, np.nan)
+            closes[cell[last_row]] = all_price[last_row]
+            closes = closes.reshape(num_days, num_contracts)
+            filled_day = np.maximum.accumulate(np.where(np.isnan(closes), 0, np.arange(num_days)[:, None]), axis=0)
+            closes = closes[filled_day, np.arange(num_contracts)]
+
+            roll_rows = np.flatnonzero(rollover)
+            before_roll = np.maximum(day_index[roll_rows] - 1, 0)
+            gaps = closes[before_roll, code[roll_rows]] - closes[before_roll, code[roll_rows - 1]]
+
+            # no close for one of them before the roll, fall back to the jump between the two ticks at the roll
+            gaps = np.where(np.isnan(gaps), price[roll_rows] - price[roll_rows - 1], gaps)
+
+            # everything before roll k gets shifted by the sum of the gaps from roll k onwards
+            adjustment = np.append(np.cumsum(gaps[::-1])[::-1], 0.0)
+            price = price + adjustment[np.searchsorted(roll_rows, np.arange(len(price)), side="right")]
+
+        selected_ticks = ticks.filter(pl.Series(selected))
+
+        return pl.DataFrame([
+            pl.Series("datetime", time.view("datetime64[us]")),
+            pl.Series("price", price),
+            selected_ticks["volume"],
+            selected_ticks["num_trades"],
+            selected_ticks["bid_volume"],
+            selected_ticks["ask_volume"],
+            pl.Series("active_contract_id", np.array(contract_ids, dtype=object)[code].astype(str)),
+            pl.Series("rollover_flag", rollover),
+        ]).with_columns(
+            pl.lit(symbol).alias("symbol"),
+            pl.col("datetime").dt.replace_time_zone("UTC"),
+        ).select(TABLE_COLUMNS["continuous_contracts"])
+
+    @classmethod
+    def write(cls, conn, symbol: str, continuous: pl.DataFrame, replace: bool = True) -> int:
+        """
+        This function bulk writes a built series into continuous_contracts through DatabaseUtility.load_data_to_db
+        With replace the symbol's old rows get deleted in the same transaction, needed after a re-roll since back adjusted prices all move
+        """
+        # partitions first, on their own connection so they never commit the DELETE below early
+        if len(continuous):
+            DatabaseUtility.ensure_partitions(conn, "continuous_contracts", continuous["datetime"].min(), continuous["datetime"].max())
+
+        if replace:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM continuous_contracts WHERE symbol = %s", (symbol,))
+            cur.close()
+
+        return DatabaseUtility.load_data_to_db(conn, continuous, "continuous_contracts")
+
+    @classmethod
+    def rebuild(cls, conn, symbol: str, rule: str = "volume", back_adjust: bool = False, day_offset_hours: int = 0) -> int:
+        """
+        This function rebuilds the whole continuous series of a symbol from raw_contracts, e.g. after a new roll
+        """
+        contracts = cls.from_database(conn, symbol)
+        if not contracts:
+            return 0
+
+        continuous = cls.build(symbol, contracts, rule=rule, back_adjust=back_adjust, day_offset_hours=day_offset_hours)
+        return cls.write(conn, symbol, continuous)
@@ -1,15 +1,67 @@
 """
 This file contains all of the functions for connecting to the database and all that
 """
+import io
+import datetime
+import numpy as np
+import polars as pl
 import psycopg2
+import psycopg2.pool
+from scid_parsing_uitl import ScidUtility
+from ingest_catalog import IngestCatalog
+
+# columns (in insert order) and upsert keys for the tables we load into
+TABLE_COLUMNS = {
+    "raw_contracts": ("contract_id", "symbol", "expiry_date", "datetime", "price", "num_trades", "bid_volume", "ask_volume"),
+    "continuous_contracts": ("symbol", "datetime", "price", "volume", "num_trades", "bid_volume", "ask_volume", "active_contract_id", "rollover_flag"),
+}
+CONFLICT_KEYS = {
+    "raw_contracts": ("contract_id", "datetime"),
+    "continuous_contracts": ("symbol", "datetime"),
+}
+UPDATE_COLUMNS = {
+    "raw_contracts": ("price", "num_trades", "bid_volume", "ask_volume"),
+    "continuous_contracts": ("price", "volume", "num_trades", "bid_volume", "ask_volume", "active_contract_id", "rollover_flag"),
+}
+COPY_CHUNK_ROWS = 1_000_000
+
+# how read_ticks pulls each column out of COPY and the type polars reads it as, datetime stays text (Postgres formats
+# it cheaper than it computes an epoch) and gets parsed by polars, rollover_flag travels as 0/1
+READ_COLUMNS = {
+    "contract_id": ("contract_id", pl.Utf8),
+    "symbol": ("symbol", pl.Utf8),
+    "expiry_date": ("expiry_date", pl.Date),
+    "datetime": ("datetime", pl.Utf8),
+    "price": ("price", pl.Float64),
+    "volume": ("volume", pl.Int64),
+    "num_trades": ("num_trades", pl.Int32),
+    "bid_volume": ("bid_volume", pl.Int32),
+    "ask_volume": ("ask_volume", pl.Int32),
+    "active_contract_id": ("active_contract_id", pl.Utf8),
+    "rollover_flag": ("rollover_flag::int", pl.Int8),
+}
+
+# how many months past the current one the partitioned schema keeps created ahead of the data
+PARTITION_MONTHS_AHEAD = 3
+
+# every connection works in UTC, naive datetimes are UTC throughout the series
+SESSION_OPTIONS = "-c timezone=UTC"
+
+# how long creating a partition waits for the parent table's lock before giving up
+PARTITION_LOCK_TIMEOUT = '10s'
 
 
 class DatabaseUtility:
 
+    # table -> whether it's range partitioned, and the (table, month) partitions known to exist, per process
+    _partitioned = {}
+    _partitions = set()
+
     @classmethod
     def database_connect(cls, db_name, user, password, host='localhost', port='5432'):
         """
         This function returns a connection to the desired database
+        The session runs in UTC, so naive datetimes are stored as UTC and land in the partition partition_month says
         """
         return psycopg2.connect(
             dbname=db_name,
@@ -17,6 +69,23 @@ class DatabaseUtility:
             password=password,
             host=host,
             port=port,
+            options=SESSION_OPTIONS,
+        )
+
+    @classmethod
+    def connection_pool(cls, db_name, user, password, minconn=1, maxconn=4, host='localhost', port='5432'):
+        """
+        This function returns a thread safe pool of connections to the desired database, for when several threads write at once
+        """
+        return psycopg2.pool.ThreadedConnectionPool(
+            minconn,
+            maxconn,
+            dbname=db_name,
+            user=user,
+            password=password,
+            host=host,
+            port=port,
+            options=SESSION_OPTIONS,
         )
 
     @classmethod
@@ -52,10 +121,20 @@ class DatabaseUtility:
             conn.close()
     
     @classmethod
-    def create_tables(cls, db_name, user, password, host='localhost', port='5432') -> None:
+    def create_tables(cls, db_name, user, password, host='localhost', port='5432', partitioned=False,
+                      first_month=None, months_ahead=PARTITION_MONTHS_AHEAD) -> None:
         """
         This function creates tables for storing commodity data that we parsed from .scid files provided by SC
+
+        partitioned=True makes raw_contracts/continuous_contracts range partitioned by month on datetime instead of
+        single tables, each month is its own table with its own (small) unique index, so inserts only touch the
+        current month's index and date range queries only read the months they cover
+        Partitions from first_month (a date, defaults to this month) to months_ahead months from now get created here,
+        ensure_partitions creates the rest as data for them shows up
         """
+        if partitioned:
+            cls.create_partitioned_tables(db_name, user, password, host, port, first_month, months_ahead)
+            return
 
         conn_string = f"dbname={db_name} user={user} password={password} host={host} port={port}"
 
@@ -108,8 +187,7 @@ class DatabaseUtility:
                 ON continuous_contracts(symbol, datetime);
             """)
 
-            # TODO
-            # could add tables to track the files used and processing times
+            # the files used and processing times are tracked in the ingest catalog (ingest_catalog.py)
 
             conn.commit()
             print("Tables created successfully")
@@ -121,8 +199,372 @@ class DatabaseUtility:
             conn.close()
     
     @classmethod
-    def load_data_to_db(cls, conn, df, table_name):
+    def create_partitioned_tables(cls, db_name, user, password, host='localhost', port='5432', first_month=None,
+                                  months_ahead=PARTITION_MONTHS_AHEAD) -> None:
+        """
+        This function creates the monthly partitioned versions of raw_contracts and continuous_contracts, see create_tables
+        The primary key has to include the partition column, so it's (id, datetime), and the unique keys the upserts
+        rely on already do. A table that already exists unpartitioned is left alone
+        """
+        conn = cls.database_connect(db_name, user, password, host, port)
+        cur = conn.cursor()
+
+        try:
+            for table_name in TABLE_COLUMNS:
+                cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table_name,))
+                if cur.fetchone()[0] and not cls.is_partitioned(conn, table_name):
+                    print(f"{table_name} already exists as a single table, leaving it unpartitioned")
+
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS raw_contracts (
+                    id BIGSERIAL,
+                    contract_id VARCHAR(50) NOT NULL,
+                    symbol VARCHAR(20) NOT NULL,
+                    expiry_date DATE,
+                    datetime TIMESTAMP WITH TIME ZONE NOT NULL,
+                    price DECIMAL(12, 6),
+                    num_trades INTEGER,
+                    bid_volume INTEGER,
+                    ask_volume INTEGER,
+                    PRIMARY KEY (id, datetime),
+                    UNIQUE (contract_id, datetime)
+                ) PARTITION BY RANGE (datetime);
+            """)
+
+            # the unique keys double as the (contract_id/symbol, datetime) lookup indexes, so no separate index here
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS continuous_contracts (
+                    id BIGSERIAL,
+                    symbol VARCHAR(20) NOT NULL,
+                    datetime TIMESTAMP WITH TIME ZONE NOT NULL,
+                    price DECIMAL(12, 6),
+                    volume INTEGER,
+                    num_trades INTEGER,
+                    bid_volume INTEGER,
+                    ask_volume INTEGER,
+                    active_contract_id VARCHAR(50) NOT NULL,
+                    rollover_flag BOOLEAN DEFAULT FALSE,
+                    PRIMARY KEY (id, datetime),
+                    UNIQUE (symbol, datetime)
+                ) PARTITION BY RANGE (datetime);
+            """)
+            conn.commit()
+            cls._partitioned.clear()
+
+            today = datetime.date.today()
+            first_month = first_month or today
+            last_month = cls.add_months(today, months_ahead)
+            for table_name in TABLE_COLUMNS:
+                cls.ensure_partitions(conn, table_name, first_month, last_month)
+
+            print("Partitioned tables created successfully")
+        except Exception as e:
+            conn.rollback()
+            print(f"Error creating partitioned tables:\n{e}")
+        finally:
+            cur.close()
+            conn.close()
+
+    @classmethod
+    def is_partitioned(cls, conn, table_name) -> bool:
+        """
+        This function says whether a table is partitioned, looked up once per process
+        The lookup runs on conn but never commits or rolls back, whatever the caller has open stays open
+        """
+        if table_name not in cls._partitioned:
+            with conn.cursor() as cur:
+                cur.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))", (table_name,))
+                cls._partitioned[table_name] = cur.fetchone()[0]
+
+        return cls._partitioned[table_name]
+
+    @classmethod
+    def add_months(cls, day, months: int) -> datetime.date:
+        """ First day of the month months after day's month """
+        month = day.year * 12 + day.month - 1 + months
+        return datetime.date(month // 12, month % 12 + 1, 1)
+
+    @classmethod
+    def partition_month(cls, value) -> datetime.date:
+        """ The month (as its first day) whose partition holds value, datetimes are taken in UTC and naive ones as UTC """
+        return cls.add_months(cls._as_utc(value), 0)
+
+    @classmethod
+    def ensure_partitions(cls, conn, table_name, start, end) -> None:
         """
-        This function inserts data into the desired table and then updates the appropirate json file settings
+        This function makes sure table_name has a partition for every month from start to end (dates or datetimes, inclusive)
+        The months are UTC months, like the partition bounds, see partition_month
+        Does nothing for an unpartitioned table, and months this process already knows about cost nothing, so it can be
+        called before every write
+
+        Missing partitions are created and committed on a separate autocommit connection, conn's transaction is never
+        committed from here. Attaching one only waits on DDL or a VACUUM holding the parent table (up to PARTITION_LOCK_TIMEOUT)
         """
-        pass
\ No newline at end of file
+        if not cls.is_partitioned(conn, table_name):
+            return
+
+        missing = []
+        month = cls.partition_month(start)
+        last = cls.partition_month(end)
+        while month <= last:
+            if (table_name, month) not in cls._partitions:
+                missing.append(month)
+            month = cls.add_months(month, 1)
+        if not missing:
+            return
+
+        side_conn = cls._side_connection(conn)
+        try:
+            for month in missing:
+                cls._create_partition(side_conn, table_name, month)
+                cls._partitions.add((table_name, month))
+        finally:
+            side_conn.close()
+
+    @classmethod
+    def _side_connection(cls, conn):
+        """
+        A new autocommit connection to the same database as conn, for DDL that mustn't land in conn's transaction
+        """
+        side_conn = psycopg2.connect(**conn.get_dsn_parameters(), password=conn.info.password)
+        side_conn.autocommit = True
+        with side_conn.cursor() as cur:
+            cur.execute(f"SET lock_timeout = '{PARTITION_LOCK_TIMEOUT}'")
+
+        return side_conn
+
+    @classmethod
+    def _create_partition(cls, conn, table_name, month) -> None:
+        """
+        One month's partition on an autocommit connection, another writer creating the same one at the same moment is fine
+        The table is made on its own and then attached, ATTACH PARTITION only needs a SHARE UPDATE EXCLUSIVE lock on the
+        parent so it doesn't wait on transactions that are reading or writing it (PARTITION OF needs ACCESS EXCLUSIVE)
+        """
+        partition = f"{table_name}_{month:%Y_%m}"
+        with conn.cursor() as cur:
+            cur.execute("SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s))", (partition,))
+            if cur.fetchone()[0]:
+                return
+            try:
+                cur.execute(f"CREATE TABLE IF NOT EXISTS {partition} (LIKE {table_name} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+                cur.execute(f"""
+                    ALTER TABLE {table_name} ATTACH PARTITION {partition}
+                    FOR VALUES FROM ('{month} 00:00:00+00') TO ('{cls.add_months(month, 1)} 00:00:00+00')
+                """)
+                print(f"Created partition {partition}")
+            except psycopg2.Error:
+                # lost the race to another writer, anything else is a real error
+                cur.execute("SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s))", (partition,))
+                if not cur.fetchone()[0]:
+                    raise
+
+    @classmethod
+    def iter_ticks(cls, conn, table_name, contract_id=None, symbol=None, start=None, end=None, columns=None, chunk=None):
+        """
+        This function is a generator that reads one contract (raw_contracts) or symbol (either table) between
+        start and end (start <= datetime < end) and yields it as polars DataFrames in datetime order
+
+        Every chunk is one COPY (...) TO STDOUT in CSV read straight into typed columns by polars, so no rows
+        ever become python tuples. Chunks are calendar months by default (one partition each with the partitioned
+        schema), or windows of chunk (a timedelta). A missing start/end is taken from the data
+
+        columns picks a subset of the table's columns, datetime comes back as a UTC microsecond Datetime
+        """
+        columns = list(columns or TABLE_COLUMNS[table_name])
+        if contract_id is not None:
+            where, key = "contract_id = %s", contract_id
+        elif symbol is not None:
+            where, key = "symbol = %s", symbol
+        else:
+            raise ValueError("iter_ticks needs a contract_id or a symbol")
+
+        with conn.cursor() as cur:
+            if start is None or end is None:
+                cur.execute(f"SELECT min(datetime), max(datetime) FROM {table_name} WHERE {where}", (key,))
+                first, last = cur.fetchone()
+                if first is None:
+                    return
+                start = start or first
+                end = end or last + datetime.timedelta(microseconds=1)
+
+            start, end = cls._as_utc(start), cls._as_utc(end)
+            select = ", ".join(READ_COLUMNS[column][0] for column in columns)
+            schema = {column: READ_COLUMNS[column][1] for column in columns}
+
+            window_start = start
+            while window_start < end:
+                if chunk is None:
+                    month = cls.add_months(window_start, 1)
+                    window_end = min(end, datetime.datetime(month.year, month.month, 1, tzinfo=datetime.timezone.utc))
+                else:
+                    window_end = min(end, window_start + chunk)
+
+                query = cur.mogrify(
+                    f"SELECT {select} FROM {table_name} WHERE {where} AND datetime >= %s AND datetime < %s ORDER BY datetime",
+                    (key, window_start, window_end)
+                ).decode('utf-8')
+                buffer = io.BytesIO()
+                cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv)", buffer)
+
+                if buffer.tell():
+                    buffer.seek(0)
+                    yield cls._read_types(pl.read_csv(buffer, has_header=False, new_columns=columns, schema=schema))
+
+                window_start = window_end
+
+    @classmethod
+    def read_ticks(cls, conn, table_name, contract_id=None, symbol=None, start=None, end=None, columns=None,
+                   chunk=None, as_numpy=False):
+        """
+        This function reads everything iter_ticks would yield into one contiguous polars DataFrame,
+        or with as_numpy=True a {column: numpy array} dict (datetime as datetime64[us])
+        """
+        frames = list(cls.iter_ticks(conn, table_name, contract_id, symbol, start, end, columns, chunk))
+        if frames:
+            frame = pl.concat(frames, rechunk=True)
+        else:
+            columns = list(columns or TABLE_COLUMNS[table_name])
+            frame = cls._read_types(pl.DataFrame(schema={column: READ_COLUMNS[column][1] for column in columns}))
+
+        if as_numpy:
+            return {
+                column: (frame[column].dt.replace_time_zone(None) if column == "datetime" else frame[column]).to_numpy()
+                for column in frame.columns
+            }
+
+        return frame
+
+    @classmethod
+    def _read_types(cls, frame) -> pl.DataFrame:
+        """ The columns that COPY can't hand over in their final type (see READ_COLUMNS) """
+        if "datetime" in frame.columns:
+            frame = frame.with_columns(
+                pl.col("datetime").str.to_datetime("%Y-%m-%d %H:%M:%S%.f%#z", time_unit="us").dt.convert_time_zone("UTC")
+            )
+        if "rollover_flag" in frame.columns:
+            frame = frame.with_columns(pl.col("rollover_flag").cast(pl.Boolean))
+
+        return frame
+
+    @classmethod
+    def _as_utc(cls, value) -> datetime.datetime:
+        """ A date or datetime as an aware UTC datetime, naive values are taken as UTC like everywhere else here """
+        if not isinstance(value, datetime.datetime):
+            value = datetime.datetime(value.year, value.month, value.day)
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+
+        return value.astimezone(datetime.timezone.utc)
+
+    @classmethod
+    def upsert_sql(cls, table_name, source) -> str:
+        """
+        This function builds the INSERT ... ON CONFLICT DO UPDATE statement for one of our tables
+        source is whatever goes after the column list, e.g. "VALUES %s" or a SELECT from a staging table
+        """
+        columns = TABLE_COLUMNS[table_name]
+        conflict_keys = CONFLICT_KEYS[table_name]
+        updates = ",\n            ".join(f"{col} = EXCLUDED.{col}" for col in UPDATE_COLUMNS[table_name])
+
+        return f"""
+            INSERT INTO {table_name}
+            ({", ".join(columns)})
+            {source}
+            ON CONFLICT ({", ".join(conflict_keys)}) DO UPDATE SET
+            {updates}
+        """
+
+    @classmethod
+    def to_table_frame(cls, data, table_name, contract_id=None, symbol=None, expiry_date=None) -> pl.DataFrame:
+        """
+        This function lines data up with the columns of table_name
+        data can be a parsed scid numpy array (either dtype in the repo, fields are taken by position),
+        or a pandas/polars DataFrame that already has the table's column names
+
+        For a scid array the contract/symbol/expiry are filled in from the arguments,
+        for continuous_contracts the contract_id is used as the active contract
+        """
+        if isinstance(data, np.ndarray) and data.dtype.names:
+            names = data.dtype.names
+            frame = pl.DataFrame([
+                pl.Series("datetime", ScidUtility.sc_to_datetime64(data[names[0]])),
+                pl.Series("price", np.ascontiguousarray(data[names[4]])),
+                pl.Series("volume", np.ascontiguousarray(data[names[6]])),
+                pl.Series("num_trades", np.ascontiguousarray(data[names[5]])),
+                pl.Series("bid_volume", np.ascontiguousarray(data[names[7]])),
+                pl.Series("ask_volume", np.ascontiguousarray(data[names[8]])),
+            ]).with_columns(
+                pl.lit(contract_id).alias("contract_id"),
+                pl.lit(contract_id).alias("active_contract_id"),
+                pl.lit(symbol).alias("symbol"),
+                pl.lit(expiry_date).alias("expiry_date"),
+                pl.lit(False).alias("rollover_flag"),
+            )
+        elif isinstance(data, pl.DataFrame):
+            frame = data
+        else:
+            frame = pl.from_pandas(data)
+
+        # timestamptz has to be told the values are UTC, naive values would be read in the session time zone
+        if frame.schema["datetime"] == pl.Datetime and frame.schema["datetime"].time_zone is None:
+            frame = frame.with_columns(pl.col("datetime").dt.replace_time_zone("UTC"))
+
+        return frame.select(TABLE_COLUMNS[table_name])
+
+    @classmethod
+    def load_data_to_db(cls, conn, df, table_name, contract_id=None, symbol=None, expiry_date=None,
+                        new_position=None, chunk_rows=COPY_CHUNK_ROWS) -> int:
+        """
+        This function inserts data into the desired table and then updates the symbol's checkpoint in the ingest catalog
+
+        The data gets streamed with COPY FROM STDIN into a temp staging table chunk_rows at a time
+        and merged into the real table with one upsert per chunk, rows with the same key keep the last one in df
+        Everything is one transaction, the checkpoint (new_position from parse_scid) only moves after it commits
+        With the partitioned schema the data's months are created first on their own connection (see ensure_partitions)
+
+        See to_table_frame for what df can be, returns the number of rows loaded
+        """
+        frame = cls.to_table_frame(df, table_name, contract_id, symbol, expiry_date)
+        if len(frame):
+            cls.ensure_partitions(conn, table_name, frame["datetime"].min(), frame["datetime"].max())
+        columns = TABLE_COLUMNS[table_name]
+        conflict_keys = ", ".join(CONFLICT_KEYS[table_name])
+        column_list = ", ".join(columns)
+        cur = conn.cursor()
+
+        try:
+            cur.execute(f"""
+                CREATE TEMP TABLE IF NOT EXISTS stage_{table_name}
+                ON COMMIT DROP
+                AS SELECT {column_list} FROM {table_name} WITH NO DATA
+            """)
+            # numbers the rows in the order COPY reads them, so the merge can tell which duplicate came last
+            cur.execute(f"ALTER TABLE stage_{table_name} ADD COLUMN IF NOT EXISTS ord BIGSERIAL")
+
+            for start in range(0, len(frame), chunk_rows):
+                buffer = io.BytesIO()
+                frame.slice(start, chunk_rows).write_csv(buffer, include_header=False)
+                buffer.seek(0)
+
+                cur.copy_expert(f"COPY stage_{table_name} ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+                cur.execute(cls.upsert_sql(table_name, f"""
+                    SELECT DISTINCT ON ({conflict_keys}) {column_list}
+                    FROM stage_{table_name}
+                    ORDER BY {conflict_keys}, ord DESC
+                """))
+                cur.execute(f"TRUNCATE stage_{table_name}")
+
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error loading data into {table_name}:\n{e}")
+            raise
+        finally:
+            cur.close()
+
+        settings_symbol = contract_id or symbol
+        if new_position is not None and settings_symbol and len(frame):
+            last_timestamp = frame["datetime"].max().isoformat()
+            IngestCatalog.update_symbol_checkpoint(settings_symbol, new_position, last_timestamp)
+
+        return len(frame)
@@ -0,0 +1,246 @@
+"""
+Ingestion state catalog, replaces commodity_settings.json
+
+A SQLite file (WAL mode) with one row per symbol for the checkpoints and one row per ingest run,
+so a checkpoint is a single row upsert instead of reading and rewriting every symbol's settings,
+and several ingesters (threads or processes) can checkpoint at the same time
+
+    file_checkpoints -> last_parsed_index, last_parsed_timestamp, the file's size and mtime at that point
+    ingest_runs -> what each run read, how long it took and whether it failed
+
+An existing commodity_settings.json is imported the first time the catalog is opened
+"""
+import os
+import json
+import sqlite3
+import datetime
+import threading
+
+CATALOG_FILE = os.getenv('ingest_catalog', './ingest_catalog.db')
+LEGACY_SETTINGS_FILE = "./commodity_settings.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_checkpoints (
+    symbol TEXT PRIMARY KEY,
+    path_to_file TEXT NOT NULL,
+    last_parsed_index INTEGER NOT NULL DEFAULT 0,
+    last_parsed_timestamp TEXT NOT NULL DEFAULT '',
+    initial_load_done INTEGER NOT NULL DEFAULT 0,
+    file_size INTEGER,
+    file_mtime REAL,
+    updated_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS ingest_runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    symbol TEXT NOT NULL,
+    path_to_file TEXT,
+    start_index INTEGER,
+    end_index INTEGER,
+    num_records INTEGER NOT NULL DEFAULT 0,
+    num_bytes INTEGER NOT NULL DEFAULT 0,
+    seconds REAL,
+    status TEXT NOT NULL,
+    error TEXT,
+    finished_at TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_ingest_runs_symbol ON ingest_runs(symbol, run_id);
+"""
+
+
+class IngestCatalog:
+
+    # one connection per thread (sqlite3 connections can't be shared), reopened in a forked child
+    _local = threading.local()
+
+    @classmethod
+    def _connection(cls, catalog_file: str = None) -> sqlite3.Connection:
+        """
+        This function returns this thread's connection to the catalog, creating the tables on first use
+        Connections are in autocommit mode, every statement is its own transaction unless wrapped in BEGIN/COMMIT
+        """
+        catalog_file = catalog_file or CATALOG_FILE
+        key = (os.getpid(), os.path.abspath(catalog_file))
+        connections = cls._local.__dict__.setdefault("connections", {})
+
+        if key not in connections:
+            conn = sqlite3.connect(catalog_file, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            connections[key] = conn
+            cls._import_legacy_settings(conn)
+
+        return connections[key]
+
+    @classmethod
+    def _import_legacy_settings(cls, conn, settings_file: str = LEGACY_SETTINGS_FILE) -> None:
+        """
+        Copy the checkpoints out of commodity_settings.json into an empty catalog, the json file is left where it is
+        """
+        if not os.path.exists(settings_file) or conn.execute("SELECT 1 FROM file_checkpoints LIMIT 1").fetchone():
+            return
+
+        with open(settings_file, 'r') as f:
+            symbol_settings = json.load(f).get("symbol_settings", {})
+
+        now = cls._now()
+        conn.executemany(
+            "INSERT OR IGNORE INTO file_checkpoints (symbol, path_to_file, last_parsed_index, last_parsed_timestamp, "
+            "initial_load_done, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (symbol, settings.get("path_to_file") or cls._default_path(symbol), settings.get("last_parsed_index", 0),
+                 settings.get("last_parsed_timestamp", ""), int(bool(settings.get("initial_load_done"))), now)
+                for symbol, settings in symbol_settings.items()
+            ]
+        )
+        print(f"Imported {len(symbol_settings)} symbols from {settings_file} into the ingest catalog")
+
+    @classmethod
+    def initialize(cls, catalog_file: str = None) -> str:
+        """
+        This function creates the catalog (and imports commodity_settings.json) if it isn't there yet
+        """
+        cls._connection(catalog_file)
+        return catalog_file or CATALOG_FILE
+
+    @classmethod
+    def add_symbol_settings(cls, symbol, path_to_file: str = None) -> None:
+        """
+        This function adds a symbol with nothing parsed yet, a symbol that's already there is left alone
+        path_to_file defaults to the file in the SC data folder
+        """
+        cls._connection().execute(
+            "INSERT OR IGNORE INTO file_checkpoints (symbol, path_to_file, updated_at) VALUES (?, ?, ?)",
+            (symbol, path_to_file or cls._default_path(symbol), cls._now())
+        )
+
+    @classmethod
+    def get_symbol_settings(cls, symbol) -> dict:
+        """
+        This function returns a symbol's checkpoint row as a dict, adding the default row if it isn't there yet
+        """
+        conn = cls._connection()
+        row = conn.execute("SELECT * FROM file_checkpoints WHERE symbol = ?", (symbol,)).fetchone()
+        if row is None:
+            cls.add_symbol_settings(symbol)
+            row = conn.execute("SELECT * FROM file_checkpoints WHERE symbol = ?", (symbol,)).fetchone()
+
+        settings = dict(row)
+        settings["initial_load_done"] = bool(settings["initial_load_done"])
+        return settings
+
+    @classmethod
+    def update_symbol_checkpoint(cls, symbol, last_parsed_index: int, last_parsed_timestamp: str = "", path_to_file: str = None) -> None:
+        """
+        This function records how far into a symbol's scid file we've parsed, as one single row upsert
+        When the file is known its size and mtime are stored with the checkpoint, see is_unchanged
+        """
+        file_size = file_mtime = None
+        if path_to_file:
+            try:
+                stat = os.stat(path_to_file)
+                file_size, file_mtime = stat.st_size, stat.st_mtime
+            except OSError:
+                pass
+
+        cls._connection().execute(
+            """
+            INSERT INTO file_checkpoints (symbol, path_to_file, last_parsed_index, last_parsed_timestamp,
+                                          initial_load_done, file_size, file_mtime, updated_at)
+            VALUES (?, ?, ?, ?, 1, ?, ?, ?)
+            ON CONFLICT (symbol) DO UPDATE SET
+                path_to_file = COALESCE(?, path_to_file),
+                last_parsed_index = excluded.last_parsed_index,
+                last_parsed_timestamp = excluded.last_parsed_timestamp,
+                initial_load_done = 1,
+                file_size = COALESCE(excluded.file_size, file_size),
+                file_mtime = COALESCE(excluded.file_mtime, file_mtime),
+                updated_at = excluded.updated_at
+            """,
+            (symbol, path_to_file or cls._default_path(symbol), last_parsed_index, last_parsed_timestamp,
+             file_size, file_mtime, cls._now(), path_to_file)
+        )
+
+    @classmethod
+    def is_unchanged(cls, symbol, path_to_file: str) -> bool:
+        """
+        This function says whether a file is exactly as it was at its last checkpoint (same size and mtime, and
+        parsed to the end), so it can be skipped without opening it
+        """
+        row = cls._connection().execute(
+            "SELECT last_parsed_index, file_size, file_mtime FROM file_checkpoints WHERE symbol = ?", (symbol,)
+        ).fetchone()
+        if row is None or row["file_size"] is None:
+            return False
+
+        try:
+            stat = os.stat(path_to_file)
+        except OSError:
+            return False
+
+        return stat.st_size == row["file_size"] and stat.st_mtime == row["file_mtime"] and row["last_parsed_index"] >= stat.st_size
+
+    @classmethod
+    def record_run(cls, symbol, path_to_file: str = None, start_index: int = None, end_index: int = None, num_records: int = 0,
+                   num_bytes: int = 0, seconds: float = None, status: str = "done", error: str = None) -> int:
+        """
+        This function logs one ingest of a file (or a failed attempt with status="failed" and the error), returns the run_id
+        """
+        cur = cls._connection().execute(
+            """
+            INSERT INTO ingest_runs (symbol, path_to_file, start_index, end_index, num_records, num_bytes, seconds, status, error, finished_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (symbol, path_to_file, start_index, end_index, num_records, num_bytes, seconds, status, error, cls._now())
+        )
+        return cur.lastrowid
+
+    @classmethod
+    def checkpoint_run(cls, symbol, path_to_file: str, start_index: int, end_index: int, last_parsed_timestamp: str,
+                       num_records: int, seconds: float) -> int:
+        """
+        This function moves the checkpoint and logs the run in one transaction, so the two never disagree
+        """
+        conn = cls._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cls.update_symbol_checkpoint(symbol, end_index, last_parsed_timestamp, path_to_file)
+            run_id = cls.record_run(symbol, path_to_file, start_index, end_index, num_records, end_index - start_index, seconds)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        return run_id
+
+    @classmethod
+    def run_stats(cls, symbol=None) -> list:
+        """
+        This function returns per symbol totals over the successful runs: runs, records, bytes, seconds,
+        records per second and when the last one finished
+        """
+        rows = cls._connection().execute(
+            f"""
+            SELECT symbol, COUNT(*) AS runs, SUM(num_records) AS num_records, SUM(num_bytes) AS num_bytes,
+                   SUM(seconds) AS seconds, SUM(num_records) / NULLIF(SUM(seconds), 0) AS records_per_second,
+                   MAX(finished_at) AS last_run
+            FROM ingest_runs
+            WHERE status = 'done' {"AND symbol = ?" if symbol is not None else ""}
+            GROUP BY symbol
+            ORDER BY symbol
+            """,
+            (symbol,) if symbol is not None else ()
+        ).fetchall()
+
+        return [dict(row) for row in rows]
+
+    @classmethod
+    def _default_path(cls, symbol) -> str:
+        return f"C:/SierraChart/Data/{symbol}.scid"
+
+    @classmethod
+    def _now(cls) -> str:
+        return datetime.datetime.now(datetime.timezone.utc).isoformat()
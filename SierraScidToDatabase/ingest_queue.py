@@ -0,0 +1,184 @@
+"""
+Bounded queue with an on disk spool for the market data server's writers
+
+Items normally go through an in memory queue with a fixed size, a full queue blocks the producer for a moment
+(so the socket reader stops reading and TCP pushes back on the client) and after that everything is appended to a
+spool file instead, which keeps memory flat while the database is slow or down
+With put_timeout=0 (the asyncio server, whose producers run on the event loop) a full queue spills right away
+
+Once the queue starts spilling every new item goes to the spool until the writer has read the whole spool back,
+so items still come out in the order they went in
+The spool is only cleared once it has been read to the end, by then every batch taken from it has been committed,
+so a spool left behind by a crash is replayed from the start on the next run (the upserts make the repeats harmless)
+"""
+import os
+import pickle
+import time
+import struct
+import logging
+import threading
+from queue import Queue, Empty, Full
+
+logger = logging.getLogger('market_data_server')
+
+RECORD_HEADER = struct.Struct("<I")
+
+
+class SpooledQueue:
+
+    def __init__(self, spool_path: str, maxsize: int = 100_000, put_timeout: float = 0.5):
+        self.queue = Queue(maxsize)
+        self.spool_path = spool_path
+        self.put_timeout = put_timeout
+
+        self._lock = threading.Lock()
+        self._append_file = None
+        self._read_file = None
+        self.spooled = 0
+
+        # anything left over from the last run goes out before new data
+        self.spooling = os.path.exists(spool_path) and os.path.getsize(spool_path) > 0
+        if self.spooling:
+            self._repair()
+            logger.warning(f"Replaying {self.spooled:,} items left in {spool_path}")
+
+    def put(self, item) -> None:
+        """
+        This function queues an item, waiting up to put_timeout for room before spilling to the spool
+        put_timeout=0 never waits
+        """
+        if not self.spooling:
+            try:
+                if self.put_timeout > 0:
+                    self.queue.put(item, timeout=self.put_timeout)
+                else:
+                    self.queue.put_nowait(item)
+                return
+            except Full:
+                pass
+
+        with self._lock:
+            # the writer may have just finished replaying the spool
+            if not self.spooling:
+                try:
+                    self.queue.put_nowait(item)
+                    return
+                except Full:
+                    self.spooling = True
+                    logger.warning(f"Queue full, spooling to {self.spool_path}")
+
+            self._append(item)
+
+    def get_batch(self, max_rows: int, max_latency: float) -> list:
+        """
+        This function blocks until there is at least one item and returns up to max_rows rows worth of them,
+        waiting at most max_latency after the first one for the batch to fill up
+        An item counts as its num_rows (for batches of rows) or as one row
+        The in memory queue is always emptied before the spool is read, since everything in it is older
+        """
+        while True:
+            if self.spooling and self.queue.empty():
+                batch = self._read(max_rows)
+                if batch:
+                    return batch
+                continue
+
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+                break
+            except Empty:
+                continue
+
+        deadline = time.monotonic() + max_latency
+        rows = getattr(batch[0], "num_rows", 1)
+
+        # take whatever is already waiting, then wait out the rest of the latency budget for more
+        while rows < max_rows:
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except Empty:
+                    break
+
+            batch.append(item)
+            rows += getattr(item, "num_rows", 1)
+
+        return batch
+
+    def qsize(self) -> int:
+        return self.queue.qsize() + self.spooled
+
+    def _repair(self) -> None:
+        """
+        Count the records in a leftover spool and cut off a half written one at the end (a crash mid append),
+        otherwise everything appended after it would be unreadable
+        """
+        file_size = os.path.getsize(self.spool_path)
+        position = 0
+
+        with open(self.spool_path, "r+b") as spool:
+            while position + RECORD_HEADER.size <= file_size:
+                spool.seek(position)
+                (size,) = RECORD_HEADER.unpack(spool.read(RECORD_HEADER.size))
+                if position + RECORD_HEADER.size + size > file_size:
+                    break
+                position += RECORD_HEADER.size + size
+                self.spooled += 1
+
+            if position < file_size:
+                logger.error(f"Cutting a half written record off the end of {self.spool_path}")
+                spool.truncate(position)
+
+    def _append(self, item) -> None:
+        """
+        Append one length prefixed pickle to the spool, flushed right away so a crashed process doesn't lose it
+        """
+        if self._append_file is None:
+            os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+            self._append_file = open(self.spool_path, "ab")
+
+        payload = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        self._append_file.write(RECORD_HEADER.pack(len(payload)) + payload)
+        self._append_file.flush()
+        self.spooled += 1
+
+    def _read(self, max_rows: int) -> list:
+        """
+        Read the next max_rows items off the spool, once it's read to the end the file is cleared and spooling stops
+        """
+        with self._lock:
+            if self._read_file is None:
+                self._read_file = open(self.spool_path, "rb")
+
+            items = []
+            rows = 0
+            while rows < max_rows:
+                position = self._read_file.tell()
+                header = self._read_file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    self._read_file.seek(position)
+                    break
+
+                (size,) = RECORD_HEADER.unpack(header)
+                items.append(pickle.loads(self._read_file.read(size)))
+                rows += getattr(items[-1], "num_rows", 1)
+
+            self.spooled = max(self.spooled - len(items), 0)
+
+            if not items:
+                self._read_file.close()
+                self._read_file = None
+                if self._append_file is not None:
+                    self._append_file.close()
+                    self._append_file = None
+                os.remove(self.spool_path)
+                self.spooled = 0
+                self.spooling = False
+                logger.info(f"Spool {self.spool_path} replayed, back to the in memory queue")
+
+            return items
@@ -1,48 +1,38 @@
-import os
-import json
+from ingest_catalog import IngestCatalog
 
 
 
 class JSONUtility:
+    """
+    The symbol checkpoints used to live in commodity_settings.json, they're in the ingest catalog now
+    (see ingest_catalog, which imports an existing json file on first use), these just hand off to it
+    so there's only ever one checkpoint store
+    """
 
     @classmethod
     def initialize_settings(cls) -> str:
         """
-        This function creates the empty setting file for the individual commodities
+        This function creates the ingest catalog if it isn't there yet and returns its path
         """
-        settings_file = "./commodity_settings.json"
-
-        if not os.path.exists(settings_file):
-            settings_dict = {
-                "symbol_settings" : {},
-            }
-
-            with open(settings_file, 'w') as f:
-                json.dump(settings_dict, f, indent=4)
-            
-            print(f"Created JSON settings file: {settings_file}")
-        
-        return settings_file
+        return IngestCatalog.initialize()
     
     @classmethod
-    def add_symbol_settings(cls, symbol) -> None:
+    def add_symbol_settings(cls, symbol, path_to_file: str = None) -> None:
         """
-        This function adds a symbol to our json settings file with the params:
-            "last_parsed_index"
-            "initial_load_done" (may remove in future, probably redundant)
-            "last_parsed_timestamp"
-            "path_to_file"
+        This function adds a symbol with nothing parsed yet, see IngestCatalog.add_symbol_settings
         """
-        with open("./commodity_settings.json", 'r') as f:
-            settings = json.load(f)
+        IngestCatalog.add_symbol_settings(symbol, path_to_file)
 
-        if symbol not in settings['symbol_settings']:
-            settings['symbol_settings'][symbol] = {
-                "last_parsed_index": 0,
-                "initial_load_done": False,
-                "last_parsed_timestamp": "",
-                "path_to_file": f"C:/SierraChart/Data/{symbol}.scid",
-            }
-        
-        with open("./commodity_settings.json", 'w') as f:
-            json.dump(settings, f, indent=4)
\ No newline at end of file
+    @classmethod
+    def get_symbol_settings(cls, symbol) -> dict:
+        """
+        This function returns a symbol's checkpoint, see IngestCatalog.get_symbol_settings
+        """
+        return IngestCatalog.get_symbol_settings(symbol)
+
+    @classmethod
+    def update_symbol_checkpoint(cls, symbol, last_parsed_index: int, last_parsed_timestamp: str = "", path_to_file: str = None) -> None:
+        """
+        This function records how far into a symbol's scid file we've parsed, see IngestCatalog.update_symbol_checkpoint
+        """
+        IngestCatalog.update_symbol_checkpoint(symbol, last_parsed_index, last_parsed_timestamp, path_to_file)
@@ -0,0 +1,208 @@
+"""
+Last value cache and live fan out for the market data server
+
+Every tick that reaches the server also updates the latest tick and a rolling bar for its key
+(contract_id for raw ticks, symbol for continuous ticks), which can be read in process with LiveCache.get
+or streamed to clients that send a subscribe message over the same socket
+
+Subscribers get one update per key per decoded batch (the latest tick plus the bar), pushed onto a bounded deque,
+a subscriber that reads too slowly loses its oldest updates instead of holding up ingestion
+Turning the updates into JSON happens on the subscriber's own sender, not on the ingest path
+"""
+import json
+import threading
+from collections import deque, defaultdict
+from tick_batch import TickBatch
+from wire_protocol import WireProtocol
+
+BAR_SECONDS = 60
+SUBSCRIBER_BUFFER = 10_000
+
+# where the fields are in the raw_contracts / continuous_contracts rows
+RAW_FIELDS = ("contract_id", "symbol", "expiry_date", "timestamp", "price", "num_trades", "bid_volume", "ask_volume")
+CONTINUOUS_FIELDS = ("symbol", "timestamp", "price", "volume", "num_trades", "bid_volume", "ask_volume",
+                     "active_contract_id", "rollover_flag")
+BAR_FIELDS = ("start", "open", "high", "low", "close", "volume")
+
+
+class Subscriber:
+    """
+    One connection's subscriptions and its bounded buffer of pending updates
+    wakeup is set by the connection's sender (e.g. an Event's set) and called whenever something gets pushed
+    """
+
+    def __init__(self, maxlen: int = SUBSCRIBER_BUFFER):
+        self.updates = deque(maxlen=maxlen)
+        self.keys = set()
+        self.dropped = 0
+        self.closed = False
+        self.wakeup = None
+
+    def push(self, update) -> None:
+        if len(self.updates) == self.updates.maxlen:
+            self.dropped += 1
+        self.updates.append(update)
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def drain(self) -> list:
+        """ Everything waiting, oldest first """
+        updates = []
+        while self.updates:
+            updates.append(self.updates.popleft())
+        return updates
+
+    def close(self) -> None:
+        """ Tell the sender to stop """
+        self.closed = True
+        if self.wakeup is not None:
+            self.wakeup()
+
+
+class LiveCache:
+
+    def __init__(self, bar_seconds: int = BAR_SECONDS):
+        self.bar_us = bar_seconds * 1_000_000
+        self.last = {}        # key -> ("raw"/"continuous", row, bar)
+        self._bars = {}       # key -> [start (epoch us), open, high, low, close, volume], updated in place
+        self.subscribers = defaultdict(set)
+        self.dropped = 0      # updates dropped by subscribers that have gone
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        This function returns the latest tick for a contract_id (raw) or symbol (continuous) as a dict, None if there isn't one
+        """
+        entry = self.last.get(key)
+        return self.to_message(key, entry) if entry is not None else None
+
+    def update(self, batch) -> None:
+        """
+        This function folds a TickBatch into the cache and pushes the new values to the subscribers of every key in it
+        Prices and volumes that came in as strings (JSON clients) are read as numbers for the bar, ones that
+        aren't numbers at all leave the bar alone
+        """
+        kind = "raw" if batch.operation == "insert_raw" else "continuous"
+        columns = batch.columns
+        keys = columns[0]
+
+        if kind == "raw":
+            times, prices = columns[3], [self._number(price) for price in columns[4]]
+            volumes = [(self._number(bid) or 0) + (self._number(ask) or 0) for bid, ask in zip(columns[6], columns[7])]
+        else:
+            times, prices, volumes = columns[1], [self._number(price) for price in columns[2]], [self._number(volume) for volume in columns[3]]
+
+        # rows by key, a batch from one connection is usually a single contract
+        if len(set(keys)) == 1:
+            rows_by_key = {keys[0]: range(len(keys))}
+        else:
+            rows_by_key = defaultdict(list)
+            for i, key in enumerate(keys):
+                rows_by_key[key].append(i)
+
+        # several connection threads can update the same key, the bar's read-modify-write happens under the lock
+        # and the pushes after it
+        pushes = []
+        with self._lock:
+            for key, rows in rows_by_key.items():
+                bar = self._bars.get(key)
+                for i in rows:
+                    if times[i] is None:
+                        continue
+                    start = WireProtocol.to_epoch_us(times[i]) // self.bar_us * self.bar_us
+                    price = prices[i]
+                    if bar is None or start != bar[0]:
+                        bar = [start, price, price, price, price, 0]
+                        self._bars[key] = bar
+                    elif price is not None:
+                        bar[2] = max(bar[2], price) if bar[2] is not None else price
+                        bar[3] = min(bar[3], price) if bar[3] is not None else price
+                        bar[4] = price
+                    bar[5] += volumes[i] or 0
+
+                if bar is None:
+                    continue
+                last_row = rows[-1]
+                entry = (kind, tuple(column[last_row] for column in columns), tuple(bar))
+                self.last[key] = entry
+
+                subscribers = self.subscribers.get(key)
+                if subscribers:
+                    pushes.extend((subscriber, (key, entry)) for subscriber in subscribers)
+
+        for subscriber, update in pushes:
+            subscriber.push(update)
+
+    def update_row(self, operation: str, row: tuple) -> None:
+        """ update for a single queued row (the process_message / process_frame path) """
+        self.update(TickBatch(operation, [[value] for value in row]))
+
+    def subscribe(self, subscriber: Subscriber, keys) -> None:
+        """
+        This function subscribes to contract_ids/symbols, the current value of each one is pushed right away
+        """
+        with self._lock:
+            for key in keys:
+                self.subscribers[key].add(subscriber)
+                subscriber.keys.add(key)
+
+        for key in keys:
+            entry = self.last.get(key)
+            if entry is not None:
+                subscriber.push((key, entry))
+
+    def unsubscribe(self, subscriber: Subscriber, keys=None) -> None:
+        """ Drop some or (keys=None) all of a subscriber's keys, call it with None when the connection closes """
+        with self._lock:
+            for key in list(subscriber.keys if keys is None else keys):
+                subscribers = self.subscribers.get(key)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self.subscribers[key]
+                subscriber.keys.discard(key)
+
+    def close(self, subscriber: Subscriber) -> None:
+        """ A subscriber's connection is gone, unsubscribe it from everything and stop its sender """
+        self.unsubscribe(subscriber)
+        self.dropped += subscriber.dropped
+        subscriber.close()
+
+    def snapshot(self, subscriber: Subscriber, keys) -> None:
+        """ Push the current value of each key once without subscribing """
+        for key in keys:
+            entry = self.last.get(key)
+            if entry is not None:
+                subscriber.push((key, entry))
+
+    def live_subscribers(self) -> set:
+        return {subscriber for subscribers in list(self.subscribers.values()) for subscriber in subscribers}
+
+    def dropped_total(self) -> int:
+        return self.dropped + sum(subscriber.dropped for subscriber in self.live_subscribers())
+
+    @classmethod
+    def _number(cls, value):
+        """ value as an int or float, None if it isn't one """
+        if value is None or isinstance(value, (int, float)):
+            return value
+        for number in (int, float):
+            try:
+                return number(value)
+            except (TypeError, ValueError):
+                pass
+        return None
+
+    @classmethod
+    def to_message(cls, key, entry) -> dict:
+        """ A cache entry as the dict that goes out to subscribers """
+        kind, row, bar = entry
+        message = {"type": "tick", "kind": kind, "key": key}
+        message.update(zip(RAW_FIELDS if kind == "raw" else CONTINUOUS_FIELDS, row))
+        message["bar"] = dict(zip(BAR_FIELDS, (WireProtocol.from_epoch_us(bar[0]),) + bar[1:]))
+        return message
+
+    @classmethod
+    def encode(cls, updates) -> bytes:
+        """ Pending (key, entry) updates as newline delimited JSON, dates and datetimes go out as ISO strings """
+        return "".join(json.dumps(cls.to_message(key, entry), default=str) + "\n" for key, entry in updates).encode('utf-8')
@@ -0,0 +1,290 @@
+"""
+Order book reconstruction for SC .depth files
+
+The book is a dense array indexed by price level (in ticks) instead of a dict
+If numba is installed the events run through a compiled loop, otherwise depth commands are applied
+a whole segment at a time with numpy (only snapshot points and clear book commands break the segments up)
+"""
+import numpy as np
+from scid_parsing_uitl import ScidUtility
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# depth file commands and flags (see the SC market depth data file docs)
+DEPTH_CLEAR_BOOK = 1
+DEPTH_ADD_BID_LEVEL = 2
+DEPTH_ADD_ASK_LEVEL = 3
+DEPTH_MODIFY_BID_LEVEL = 4
+DEPTH_MODIFY_ASK_LEVEL = 5
+DEPTH_DELETE_BID_LEVEL = 6
+DEPTH_DELETE_ASK_LEVEL = 7
+DEPTH_FLAG_END_OF_BATCH = 0x01
+
+BID = 0
+ASK = 1
+
+
+def _replay_events(commands, side, level, new_size, new_orders, snapshot_mask, size, orders, best,
+                   bid_level, bid_size, bid_orders, ask_level, ask_size, ask_orders, event_position):
+    """
+    Sequential event loop used when numba is around, best holds the best bid/ask level between chunks
+    so a snapshot only walks from the top of the book instead of scanning the whole price range
+    """
+    num_levels = size.shape[1]
+    max_levels = bid_level.shape[1]
+    row = 0
+
+    for i in range(len(commands)):
+        command = commands[i]
+
+        if command == DEPTH_CLEAR_BOOK:
+            size[:, :] = 0
+            orders[:, :] = 0
+            best[BID] = -1
+            best[ASK] = num_levels
+        elif DEPTH_ADD_BID_LEVEL <= command <= DEPTH_DELETE_ASK_LEVEL:
+            book_side = side[i]
+            lvl = level[i]
+            size[book_side, lvl] = new_size[i]
+            orders[book_side, lvl] = new_orders[i]
+
+            if new_size[i] > 0:
+                if book_side == BID and lvl > best[BID]:
+                    best[BID] = lvl
+                elif book_side == ASK and lvl < best[ASK]:
+                    best[ASK] = lvl
+            elif book_side == BID and lvl == best[BID]:
+                while best[BID] >= 0 and size[BID, best[BID]] == 0:
+                    best[BID] -= 1
+            elif book_side == ASK and lvl == best[ASK]:
+                while best[ASK] < num_levels and size[ASK, best[ASK]] == 0:
+                    best[ASK] += 1
+
+        if snapshot_mask[i]:
+            event_position[row] = i
+
+            n = 0
+            lvl = best[BID]
+            while n < max_levels and lvl >= 0:
+                if size[BID, lvl] > 0:
+                    bid_level[row, n] = lvl
+                    bid_size[row, n] = size[BID, lvl]
+                    bid_orders[row, n] = orders[BID, lvl]
+                    n += 1
+                lvl -= 1
+
+            n = 0
+            lvl = best[ASK]
+            while n < max_levels and lvl < num_levels:
+                if size[ASK, lvl] > 0:
+                    ask_level[row, n] = lvl
+                    ask_size[row, n] = size[ASK, lvl]
+                    ask_orders[row, n] = orders[ASK, lvl]
+                    n += 1
+                lvl += 1
+
+            row += 1
+
+
+if njit is not None:
+    _replay_events = njit(cache=True, nogil=True)(_replay_events)
+
+
+class OrderBookReplay:
+    """
+    Replays .depth records in order into a price level book and takes top N snapshots
+
+    Snapshots can be taken every N events (1 = every event), every N microseconds of SC time,
+    or at the end of every SC batch (FLAG_END_OF_BATCH), which is when the book is actually consistent
+
+    Without numba every snapshot is a python level step, so snapshotting every event or batch
+    is a lot slower than snapshotting on an interval
+    """
+
+    def __init__(self, levels: int = 10, tick_size: float = None, chunk_events: int = 5_000_000):
+        self.levels = levels
+        self.tick_size = tick_size
+        self.chunk_events = chunk_events
+
+    @classmethod
+    def infer_tick_size(cls, prices, sample_size: int = 1_000_000) -> float:
+        """
+        This function guesses the tick size from the smallest gap between distinct prices in the first sample_size events
+        """
+        sample = np.asarray(prices[:sample_size], dtype=np.float64)
+        unique = np.unique(sample[sample > 0])
+        if len(unique) < 2:
+            raise ValueError("Not enough distinct prices to infer the tick size, pass tick_size")
+
+        return float(np.round(np.diff(unique).min(), 6))
+
+    def _snapshot_mask(self, times, flags, start, every_events, every_us, on_batch_end, next_time):
+        """
+        Mark the events in a chunk that a snapshot gets taken after
+        next_time is the first time of the following chunk (None at the end of the data) so interval edges line up across chunks
+        """
+        mask = np.zeros(len(times), dtype=bool)
+
+        if every_events:
+            mask |= (np.arange(start, start + len(times)) + 1) % every_events == 0
+        if every_us:
+            buckets = times // every_us
+            mask[:-1] |= buckets[1:] != buckets[:-1]
+            mask[-1] |= next_time is None or next_time // every_us != buckets[-1]
+        if on_batch_end:
+            mask |= (flags & DEPTH_FLAG_END_OF_BATCH) != 0
+
+        return mask
+
+    def _empty_snapshots(self, count: int) -> dict:
+        """
+        Output arrays for count snapshots, levels are book indexes until they get turned into prices at the end
+        """
+        out = {
+            "event_index": np.zeros(count, dtype=np.int64),
+            "bid_level": np.full((count, self.levels), -1, dtype=np.int64),
+            "ask_level": np.full((count, self.levels), -1, dtype=np.int64),
+        }
+        for name in ("bid_size", "bid_orders", "ask_size", "ask_orders"):
+            out[name] = np.zeros((count, self.levels), dtype=np.int64)
+
+        return out
+
+    def _replay_segments(self, commands, side, level, new_size, new_orders, snapshot_mask, size, orders, out):
+        """
+        numpy fallback for _replay_events, applies every run of events between snapshots/clears with one fancy assignment
+        """
+        num_levels = size.shape[1]
+        flat_level = np.where(side == BID, level, level + num_levels)
+        is_update = (commands >= DEPTH_ADD_BID_LEVEL) & (commands <= DEPTH_DELETE_ASK_LEVEL)
+
+        # segments end after every snapshot and right before every clear book
+        clears = np.flatnonzero(commands == DEPTH_CLEAR_BOOK)
+        boundaries = np.unique(np.concatenate(([0, len(commands)], np.flatnonzero(snapshot_mask) + 1, clears)))
+        segment = np.repeat(np.arange(len(boundaries) - 1), np.diff(boundaries))
+
+        # a level touched more than once in a segment only needs its last update,
+        # which also keeps the fancy assignment below free of repeated indices
+        key = segment * (2 * num_levels) + np.where(is_update, flat_level, 0)
+        order = np.argsort(key, kind='stable')
+        sorted_key = key[order]
+        last_in_group = np.ones(len(commands), dtype=bool)
+        last_in_group[:-1] = sorted_key[1:] != sorted_key[:-1]
+        keep = np.zeros(len(commands), dtype=bool)
+        keep[order[last_in_group]] = True
+        apply = np.flatnonzero(keep & is_update)
+        splits = np.searchsorted(apply, boundaries)
+
+        size_flat = size.reshape(-1)
+        orders_flat = orders.reshape(-1)
+        row = 0
+
+        for i in range(len(boundaries) - 1):
+            if commands[boundaries[i]] == DEPTH_CLEAR_BOOK:
+                size[:] = 0
+                orders[:] = 0
+
+            segment_apply = apply[splits[i]:splits[i + 1]]
+            size_flat[flat_level[segment_apply]] = new_size[segment_apply]
+            orders_flat[flat_level[segment_apply]] = new_orders[segment_apply]
+
+            last = boundaries[i + 1] - 1
+            if snapshot_mask[last]:
+                out["event_index"][row] = last
+                bid_levels = np.flatnonzero(size[BID])[::-1][:self.levels]
+                ask_levels = np.flatnonzero(size[ASK])[:self.levels]
+
+                for name, book_side, side_levels in (("bid", BID, bid_levels), ("ask", ASK, ask_levels)):
+                    n = len(side_levels)
+                    out[f"{name}_level"][row, :n] = side_levels
+                    out[f"{name}_size"][row, :n] = size[book_side, side_levels]
+                    out[f"{name}_orders"][row, :n] = orders[book_side, side_levels]
+                row += 1
+
+    def replay(self, records, every_events: int = None, every_us: int = None, on_batch_end: bool = False) -> dict:
+        """
+        This function applies every depth command in records (a .depth structured array, memmap is fine) in order
+        and returns the snapshots as a dict of columnar arrays:
+            "scdatetime", "event_index" -> shape (snapshots,)
+            "bid_price", "bid_size", "bid_orders", "ask_price", "ask_size", "ask_orders" -> shape (snapshots, levels)
+        Missing levels have a NaN price and zero size
+        """
+        if not (every_events or every_us or on_batch_end):
+            raise ValueError("Pick at least one of every_events, every_us or on_batch_end")
+
+        names = records.dtype.names
+        time_field = names[0]
+        orders_field = "numorders" if "numorders" in names else "numOrders"
+        prices = records["price"]
+        num_events = len(records)
+
+        if self.tick_size is None:
+            self.tick_size = self.infer_tick_size(prices)
+
+        # size the book off the full price range so it never has to grow mid replay
+        low, high = np.inf, -np.inf
+        for start in range(0, num_events, self.chunk_events):
+            chunk = np.asarray(prices[start:start + self.chunk_events])
+            chunk = chunk[chunk > 0]
+            if len(chunk):
+                low, high = min(low, chunk.min()), max(high, chunk.max())
+        if low > high:
+            low = high = 0.0
+
+        base_tick = int(np.round(low / self.tick_size))
+        num_levels = int(np.round(high / self.tick_size)) - base_tick + 1
+        size = np.zeros((2, num_levels), dtype=np.int64)
+        orders = np.zeros((2, num_levels), dtype=np.int64)
+        best = np.array([-1, num_levels], dtype=np.int64)
+
+        snapshots = []
+        for start in range(0, num_events, self.chunk_events):
+            end = min(start + self.chunk_events, num_events)
+            chunk = np.asarray(records[start:end])
+            next_time = int(records[time_field][end]) if end < num_events else None
+
+            times = chunk[time_field].astype(np.int64)
+            commands = np.ascontiguousarray(chunk["command"])
+            snapshot_mask = self._snapshot_mask(times, chunk["flags"], start, every_events, every_us, on_batch_end, next_time)
+
+            is_update = (commands >= DEPTH_ADD_BID_LEVEL) & (commands <= DEPTH_DELETE_ASK_LEVEL)
+            is_delete = (commands == DEPTH_DELETE_BID_LEVEL) | (commands == DEPTH_DELETE_ASK_LEVEL)
+            side = np.where(commands % 2 == 0, BID, ASK)
+            level = np.where(is_update, np.round(chunk["price"] / self.tick_size).astype(np.int64) - base_tick, 0)
+            new_size = np.where(is_delete, 0, chunk["quantity"]).astype(np.int64)
+            new_orders = np.where(is_delete, 0, chunk[orders_field]).astype(np.int64)
+
+            out = self._empty_snapshots(int(snapshot_mask.sum()))
+            if njit is not None:
+                _replay_events(commands, side, level, new_size, new_orders, snapshot_mask, size, orders, best,
+                               out["bid_level"], out["bid_size"], out["bid_orders"],
+                               out["ask_level"], out["ask_size"], out["ask_orders"], out["event_index"])
+            else:
+                self._replay_segments(commands, side, level, new_size, new_orders, snapshot_mask, size, orders, out)
+
+            out["scdatetime"] = times[out["event_index"]]
+            out["event_index"] += start
+            snapshots.append(out)
+
+        if snapshots:
+            result = {name: np.concatenate([out[name] for out in snapshots]) for name in snapshots[0]}
+        else:
+            result = self._empty_snapshots(0)
+            result["scdatetime"] = np.zeros(0, dtype=np.int64)
+
+        for name in ("bid", "ask"):
+            book_levels = result.pop(f"{name}_level")
+            result[f"{name}_price"] = np.where(book_levels >= 0, (book_levels + base_tick) * self.tick_size, np.nan)
+
+        return result
+
+    @classmethod
+    def replay_file(cls, file_path: str, levels: int = 10, tick_size: float = None, **snapshot_kwargs) -> dict:
+        """
+        This function memory maps a .depth file and replays the whole thing, see replay for the snapshot options
+        """
+        records, _ = ScidUtility.memmap_records(file_path)
+        return cls(levels, tick_size).replay(records, **snapshot_kwargs)
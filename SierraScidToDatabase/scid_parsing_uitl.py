@@ -1,11 +1,107 @@
 import os
 import json
+import time
+import datetime
 import numpy as np
+from ingest_catalog import IngestCatalog
 
 
+# header sizes and record layouts for the two intraday file types written by SC
+SCID_HEADER_SIZE = 56
+DEPTH_HEADER_SIZE = 64
+
+SCID_DTYPE = np.dtype([
+    ("scdatetime", "<u8"),
+    ("open", "<f4"),
+    ("high", "<f4"),
+    ("low", "<f4"),
+    ("close", "<f4"),
+    ("numtrades", "<u4"),
+    ("totalvolume", "<u4"),
+    ("bidvolume", "<u4"),
+    ("askvolume", "<u4"),
+])
+
+DEPTH_DTYPE = np.dtype([
+    ("scdatetime", "<u8"),
+    ("command", "<u1"),
+    ("flags", "<u1"),
+    ("numorders", "<u2"),
+    ("price", "<f4"),
+    ("quantity", "<u4"),
+    ("unused", "<u4"),
+])
+
+# SC datetimes are microseconds since this date, the sparse index keeps one entry per minute by default
+SC_EPOCH = datetime.datetime(1899, 12, 30, tzinfo=datetime.timezone.utc)
+SC_EPOCH_OFFSET_US = 25_569 * 86_400 * 1_000_000  # 1899-12-30 -> 1970-01-01
+SPARSE_INDEX_STEP_US = 60_000_000
+SPARSE_INDEX_CHUNK = 5_000_000
+
 
 class ScidUtility:
 
+    @classmethod
+    def get_file_specs(cls, file_path: str):
+        """
+        This function returns the header size and record dtype for a .scid or .depth file
+        """
+        if file_path.endswith(".scid"):
+            return SCID_HEADER_SIZE, SCID_DTYPE
+        elif file_path.endswith(".depth"):
+            return DEPTH_HEADER_SIZE, DEPTH_DTYPE
+
+        raise ValueError(f"Unsupported file type for {file_path}. Must be .scid or .depth file")
+
+    @classmethod
+    def memmap_records(cls, file_path: str, offset: int = 0, max_records: int = None, dtype=None):
+        """
+        This function memory maps the records of a .scid/.depth file instead of reading them into RAM
+        The offset is a byte position in the file, anything inside the header gets bumped to the first record
+        and anything that isn't on a record boundary gets rounded down to the previous one
+
+        Only complete records are mapped, so a partial record at the end of the file (SC still writing it)
+        is left alone and will be picked up on the next call once it's finished
+
+        A custom dtype can be passed as long as it has the same itemsize as the default one for the file type
+
+        This function returns the mapped records (read only) and the byte position right after the last complete record
+        """
+        header_size, default_dtype = cls.get_file_specs(file_path)
+        dtype = default_dtype if dtype is None else np.dtype(dtype)
+        record_size = dtype.itemsize
+
+        if record_size != default_dtype.itemsize:
+            raise ValueError(f"dtype itemsize {record_size} does not match the {default_dtype.itemsize} byte records in {file_path}")
+
+        file_size = os.path.getsize(file_path)
+        num_records = max(file_size - header_size, 0) // record_size
+
+        offset = max(offset, header_size)
+        start_index = min((offset - header_size) // record_size, num_records)
+        end_index = num_records if max_records is None else min(start_index + max_records, num_records)
+
+        start_position = header_size + start_index * record_size
+        new_position = header_size + end_index * record_size
+
+        # np.memmap can't map zero bytes, nothing new to hand back
+        if end_index <= start_index:
+            return np.empty(0, dtype=dtype), start_position
+
+        records = np.memmap(file_path, dtype=dtype, mode='r', offset=start_position, shape=(end_index - start_index,))
+
+        return records, new_position
+
+    @classmethod
+    def column_views(cls, records, columns=None) -> dict:
+        """
+        This function splits a structured array into a dict of per column views
+        The views share memory with the records (no copy), so on a memmap nothing is read until a column is used
+        """
+        if columns is None:
+            columns = records.dtype.names
+
+        return {name: records[name] for name in columns}
 
     @classmethod
     def parse_scid(cls, file_path: str, offset: int):
@@ -14,32 +110,223 @@ class ScidUtility:
         It uses a passed offset to determine the location from where to convert the scid files into a numpy array
         If the passed offset is 0 (no load has ever been done for this file), the entire file gets included
 
-        This function returns a np.array of the scid data, and the position of the last record parsed 
-        """
-        with open(file_path, 'rb') as scid_file:
-            scid_file.seek(0, os.SEEK_END)
-            file_size = scid_file.tell()
-            scid_types = np.dtype([
-                ("scdatetime", "<u8"),
-                ("open", "<f4"),
-                ("high", "<f4"),
-                ("low", "<f4"),
-                ("close", "<f4"),
-                ("numtrades", "<u4"),
-                ("totalvolume", "<u4"),
-                ("bidvolume", "<u4"),
-                ("askvolume", "<u4"),
-            ])
-
-            record_size = scid_types.itemsize
-
-            if offset >= file_size:
-                offset = file_size - (file_size % record_size)
-            elif offset < 56:
-                offset = 56
-            
-            scid_file.seek(offset)
-            scid_as_np_array = np.fromfile(scid_file, dtype=scid_types)
-            new_position = scid_file.tell()
+        The returned array is memory mapped, so copy it (np.array(...)) if it needs to outlive the file or be written to
+
+        This function returns a np.array of the scid data, and the position of the last record parsed
+        """
+        scid_as_np_array, new_position = cls.memmap_records(file_path, offset)
 
         return scid_as_np_array, new_position
+
+    @classmethod
+    def datetime_to_sc(cls, dt: datetime.datetime, epoch: datetime.datetime = SC_EPOCH) -> int:
+        """
+        This function converts a datetime into the raw SC datetime value (microseconds since the epoch)
+        Naive datetimes are treated as UTC since that's what SC writes to the intraday files
+        """
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=datetime.timezone.utc)
+
+        delta = dt - epoch
+        return (delta.days * 86_400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+    @classmethod
+    def sc_to_datetime(cls, sc_datetime: int, epoch: datetime.datetime = SC_EPOCH) -> datetime.datetime:
+        """
+        This function converts a raw SC datetime value back into a (UTC) datetime
+        """
+        return epoch + datetime.timedelta(microseconds=int(sc_datetime))
+
+    @classmethod
+    def sc_to_datetime64(cls, sc_datetimes) -> np.ndarray:
+        """
+        This function converts a column of raw SC datetimes into a datetime64[us] (UTC) array in one vectorized step
+        The sub millisecond part SC uses as a trade counter is kept, so ticks in the same millisecond stay unique and ordered
+        """
+        return (np.asarray(sc_datetimes, dtype=np.int64) - SC_EPOCH_OFFSET_US).astype("datetime64[us]")
+
+    @classmethod
+    def search_time(cls, times, target: int, lo: int = 0, hi: int = None) -> int:
+        """
+        This function binary searches the (monotonic) datetime column for the first index in [lo, hi) with time >= target
+        It only touches ~log2(n) records, np.searchsorted would make a contiguous copy of a strided memmap column first
+        """
+        if hi is None:
+            hi = len(times)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[mid] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    @classmethod
+    def sparse_index_path(cls, file_path: str) -> str:
+        """
+        Sidecar file that holds the sparse time index for a .scid/.depth file
+        """
+        return f"{file_path}.idx.npz"
+
+    @classmethod
+    def build_sparse_index(cls, file_path: str, step_us: int = SPARSE_INDEX_STEP_US, index_path: str = None) -> dict:
+        """
+        This function builds (or extends) a sparse index of the first record in every step_us bucket and saves it next to the file
+        If an index already exists with the same step only the records appended since it was written get scanned
+
+        The index is a dict with:
+            "keys" -> bucket number (sc datetime // step_us) of every bucket that has records
+            "first_index" -> index of the first record in that bucket
+            "num_records" -> number of records the index covers
+            "step_us" -> bucket size
+        """
+        index_path = index_path or cls.sparse_index_path(file_path)
+        records, _ = cls.memmap_records(file_path)
+        times = records[records.dtype.names[0]]
+
+        index = cls.load_sparse_index(file_path, index_path)
+        if index is None or index["step_us"] != step_us or index["num_records"] > len(records):
+            index = {
+                "keys": np.empty(0, dtype=np.int64),
+                "first_index": np.empty(0, dtype=np.int64),
+                "num_records": 0,
+                "step_us": step_us,
+            }
+
+        keys = [index["keys"]]
+        first_index = [index["first_index"]]
+        last_key = index["keys"][-1] if len(index["keys"]) else None
+
+        for start in range(index["num_records"], len(records), SPARSE_INDEX_CHUNK):
+            buckets = (np.asarray(times[start:start + SPARSE_INDEX_CHUNK]) // step_us).astype(np.int64)
+
+            new_bucket = np.empty(len(buckets), dtype=bool)
+            new_bucket[0] = last_key is None or buckets[0] != last_key
+            new_bucket[1:] = buckets[1:] != buckets[:-1]
+
+            positions = np.flatnonzero(new_bucket)
+            keys.append(buckets[positions])
+            first_index.append(positions + start)
+            last_key = buckets[-1]
+
+        index["keys"] = np.concatenate(keys)
+        index["first_index"] = np.concatenate(first_index)
+        index["num_records"] = len(records)
+
+        # write to a temp file and swap it in so a reader never sees half an index
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, keys=index["keys"], first_index=index["first_index"],
+                     num_records=index["num_records"], step_us=index["step_us"])
+        os.replace(tmp_path, index_path)
+
+        return index
+
+    @classmethod
+    def load_sparse_index(cls, file_path: str, index_path: str = None):
+        """
+        This function loads the sparse index sidecar for a file, returns None if there isn't one
+        """
+        index_path = index_path or cls.sparse_index_path(file_path)
+        if not os.path.exists(index_path):
+            return None
+
+        with np.load(index_path) as saved:
+            return {
+                "keys": saved["keys"],
+                "first_index": saved["first_index"],
+                "num_records": int(saved["num_records"]),
+                "step_us": int(saved["step_us"]),
+            }
+
+    @classmethod
+    def _index_bounds(cls, index: dict, target: int, num_records: int):
+        """
+        Narrow the binary search for target down to the records in its bucket using the sparse index
+        Records appended after the index was built are left in the search range
+        """
+        bucket = target // index["step_us"]
+        first_index = index["first_index"]
+        k_lo = np.searchsorted(index["keys"], bucket, side='left')
+        k_hi = np.searchsorted(index["keys"], bucket, side='right')
+
+        lo = int(first_index[k_lo]) if k_lo < len(first_index) else index["num_records"]
+        hi = int(first_index[k_hi]) if k_hi < len(first_index) else num_records
+
+        return lo, hi
+
+    @classmethod
+    def read_time_range(cls, file_path: str, start=None, end=None, use_index: bool = False, dtype=None,
+                        epoch: datetime.datetime = SC_EPOCH, index_path: str = None):
+        """
+        This function returns the records with start <= time < end without scanning the file
+        start/end can be datetimes or raw sc datetime ints, leaving either as None keeps that side of the file open
+
+        The datetime column is binary searched on disk and only the byte span of the window gets mapped
+        With use_index the sparse sidecar index is used (and built/extended when it's missing or stale)
+        to cut the search down to the records inside one bucket
+
+        This function returns the memory mapped records and the byte position right after the last one
+        """
+        header_size, default_dtype = cls.get_file_specs(file_path)
+        record_size = default_dtype.itemsize
+        records, _ = cls.memmap_records(file_path, dtype=dtype)
+        times = records[records.dtype.names[0]]
+        num_records = len(records)
+
+        index = None
+        if use_index:
+            index = cls.load_sparse_index(file_path, index_path)
+            if index is None or index["num_records"] != num_records:
+                index = cls.build_sparse_index(file_path, index_path=index_path)
+
+        def locate(target):
+            if isinstance(target, datetime.datetime):
+                target = cls.datetime_to_sc(target, epoch)
+
+            lo, hi = (0, num_records) if index is None else cls._index_bounds(index, target, num_records)
+            return cls.search_time(times, target, lo, hi)
+
+        start_index = 0 if start is None else locate(start)
+        end_index = num_records if end is None else max(locate(end), start_index)
+
+        return cls.memmap_records(file_path, offset=header_size + start_index * record_size,
+                                  max_records=end_index - start_index, dtype=dtype)
+
+    @classmethod
+    def follow_scid(cls, file_path: str, offset: int = 0, symbol: str = None, poll_interval: float = 0.1,
+                    max_batch_records: int = None, stop_event=None):
+        """
+        This function is a generator that follows a .scid file SC is still writing to
+        It polls the file size and yields (records, new_position) for every batch of newly appended complete records,
+        a partial record at the end of the file waits until SC finishes writing it
+
+        When a symbol is given, it resumes from that symbol's last_parsed_index in the ingest catalog
+        and checkpoints it (one row update) once the consumer comes back for the next batch, so a batch is only
+        marked as parsed after it has been handled
+
+        Pass a threading.Event as stop_event to end the generator from another thread
+        """
+        position = offset
+        if symbol is not None:
+            position = max(position, IngestCatalog.get_symbol_settings(symbol)["last_parsed_index"])
+
+        while stop_event is None or not stop_event.is_set():
+            # SC rewrites the whole file when data gets re-downloaded, start over if it shrank under us
+            if os.path.getsize(file_path) < position:
+                position = 0
+
+            records, new_position = cls.memmap_records(file_path, position, max_batch_records)
+
+            if len(records) == 0:
+                time.sleep(poll_interval)
+                continue
+
+            yield records, new_position
+
+            position = new_position
+            if symbol is not None:
+                last_timestamp = cls.sc_to_datetime(records["scdatetime"][-1]).isoformat()
+                IngestCatalog.update_symbol_checkpoint(symbol, new_position, last_timestamp, file_path)
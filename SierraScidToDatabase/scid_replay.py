@@ -0,0 +1,170 @@
+"""
+Replays historical .scid files into the market data server through MarketDataClient
+
+Every file gets its own thread and client, and all of them share one replay clock, so bursts across symbols
+(the open, news spikes) hit the server together the way they happened:
+    --speed 1 -> original pacing
+    --speed N -> N times faster
+    --speed 0 -> as fast as possible
+
+Ticks keep their original timestamps, so replaying into the real database fills raw_contracts with real history
+
+e.g. python scid_replay.py C:/SierraChart/Data/ESU25-CME.scid C:/SierraChart/Data/NQU25-CME.scid --speed 10 --buffered --protocol binary
+"""
+import os
+import re
+import glob
+import time
+import datetime
+import argparse
+import logging
+import threading
+import numpy as np
+from scid_parsing_uitl import ScidUtility, SC_EPOCH_OFFSET_US
+from server_testing import MarketDataClient
+from wire_protocol import PROTOCOL_JSON, PROTOCOL_BINARY
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('scid_replay')
+
+CHUNK_RECORDS = 100_000
+
+# ESU25-CME -> ES, 6EZ4 -> 6E
+FUTURES_SYMBOL = re.compile(r"^([A-Z0-9]+?)[FGHJKMNQUVXZ]\d{1,2}(?:[-_.].*)?$")
+
+
+class ScidReplay:
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 5555, speed: float = 1.0, protocol: str = PROTOCOL_JSON,
+                 buffered: bool = False, chunk_records: int = CHUNK_RECORDS):
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.protocol = protocol
+        self.buffered = buffered
+        self.chunk_records = chunk_records
+
+    @classmethod
+    def contract_from_path(cls, file_path: str) -> tuple:
+        """
+        This function returns (contract_id, symbol) for a file, SC names the files after the contract (ESU25-CME.scid)
+        and the symbol is the contract without its month/year code, or the whole name if it doesn't look like a future
+        """
+        contract_id = os.path.splitext(os.path.basename(file_path))[0]
+        match = FUTURES_SYMBOL.match(contract_id)
+
+        return contract_id, match.group(1) if match else contract_id
+
+    @classmethod
+    def load_records(cls, file_path: str, start=None, end=None):
+        """
+        The records to replay, the whole file through parse_scid or just start <= time < end
+        """
+        if start is None and end is None:
+            records, _ = ScidUtility.parse_scid(file_path, 0)
+        else:
+            records, _ = ScidUtility.read_time_range(file_path, start, end, use_index=True)
+
+        return records
+
+    def replay_file(self, file_path: str, records, clock: tuple, results: dict) -> None:
+        """
+        This function streams one file's records to the server
+        clock is (wall time the replay started, SC time that maps to it), shared by every file in the run
+        """
+        contract_id, symbol = self.contract_from_path(file_path)
+        client = MarketDataClient(self.host, self.port, protocol=self.protocol, buffered=self.buffered)
+        wall_start, sc_start = clock
+        names = records.dtype.names
+        sent = 0
+        started = time.monotonic()
+
+        for chunk_start in range(0, len(records), self.chunk_records):
+            chunk = np.asarray(records[chunk_start:chunk_start + self.chunk_records])
+            sc_times = chunk[names[0]].view(np.int64)
+
+            # one vectorized pass per chunk, the send loop only touches python lists
+            epoch_us = (sc_times - SC_EPOCH_OFFSET_US).tolist()
+            prices = chunk[names[4]].astype(np.float64).tolist()
+            num_trades = chunk[names[5]].astype(np.int64).tolist()
+            bid_volumes = chunk[names[7]].astype(np.int64).tolist()
+            ask_volumes = chunk[names[8]].astype(np.int64).tolist()
+            due = (wall_start + (sc_times - sc_start) / 1e6 / self.speed).tolist() if self.speed else None
+
+            for i in range(len(epoch_us)):
+                if due is not None:
+                    wait = due[i] - time.monotonic()
+                    if wait > 0.001:
+                        time.sleep(wait)
+
+                if client.send_tick_data(contract_id, symbol, prices[i], timestamp=epoch_us[i],
+                                         num_trades=num_trades[i], bid_volume=bid_volumes[i], ask_volume=ask_volumes[i]):
+                    sent += 1
+
+        if self.buffered:
+            client.close()
+        else:
+            client.disconnect()
+
+        seconds = time.monotonic() - started
+        results[file_path] = {"contract_id": contract_id, "records": len(records), "sent": sent, "seconds": seconds, **client.stats()}
+        logger.info(f"{contract_id}: sent {sent:,}/{len(records):,} ticks in {seconds:.2f}s ({sent / max(seconds, 1e-9):,.0f} msg/s)")
+
+    def run(self, files: list, start=None, end=None) -> dict:
+        """
+        This function replays every file in parallel on one shared clock and returns per file stats
+        """
+        records = {file_path: self.load_records(file_path, start, end) for file_path in files}
+        records = {file_path: recs for file_path, recs in records.items() if len(recs)}
+        if not records:
+            logger.warning("Nothing to replay")
+            return {}
+
+        first_times = [int(recs[recs.dtype.names[0]][0]) for recs in records.values()]
+        clock = (time.monotonic() + 0.5, min(first_times))  # a little head start so every thread is up before the first tick
+
+        results = {}
+        threads = [
+            threading.Thread(target=self.replay_file, args=(file_path, recs, clock, results), name=f'replay_{i}')
+            for i, (file_path, recs) in enumerate(records.items())
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        total = sum(result["sent"] for result in results.values())
+        seconds = max(result["seconds"] for result in results.values())
+        logger.info(f"Replayed {total:,} ticks from {len(results)} files in {seconds:.2f}s ({total / max(seconds, 1e-9):,.0f} msg/s)")
+
+        return results
+
+
+def utc_datetime(value: str) -> datetime.datetime:
+    """ argparse type for --start/--end, naive times are taken as UTC like the .scid timestamps """
+    dt = datetime.datetime.fromisoformat(value)
+    return dt if dt.tzinfo else dt.replace(tzinfo=datetime.timezone.utc)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help=".scid files or glob patterns, one replay thread per file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = original pacing, N = N times faster, 0 = as fast as possible")
+    parser.add_argument("--start", type=utc_datetime, default=None, help="Only replay from this (UTC) time, e.g. 2025-06-03T13:30")
+    parser.add_argument("--end", type=utc_datetime, default=None, help="Only replay up to this (UTC) time")
+    parser.add_argument("--protocol", choices=[PROTOCOL_JSON, PROTOCOL_BINARY], default=PROTOCOL_JSON)
+    parser.add_argument("--buffered", action="store_true", help="Use the client's buffered mode")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    files = sorted({path for pattern in args.files for path in (glob.glob(pattern) or [pattern])})
+
+    ScidReplay(args.host, args.port, args.speed, args.protocol, args.buffered).run(files, args.start, args.end)
@@ -0,0 +1,233 @@
+"""
+Throughput and latency benchmark for the market data server
+
+Starts the server in this process (or points at one already running with --server), runs N MarketDataClients
+at a fixed message rate each and measures every tick from the client's send call until the row is visible:
+    --sink postgres -> visible means committed to raw_contracts, found by polling the table
+    --sink memory -> visible means handed to an in process stand in for the database (no Postgres needed),
+                     --sink-delay adds a fake commit time per batch
+
+Each tick's timestamp is its send time in epoch microseconds (bumped by 1us if a client sends twice in the same
+microsecond so the (contract_id, datetime) key stays unique), so latency is just visible time - timestamp
+
+e.g. python server_benchmark.py --clients 8 --rate 5000 --duration 20 --protocol binary --buffered --sink memory
+"""
+import time
+import argparse
+import threading
+import numpy as np
+import sierra_nw_connection as server
+from server_testing import MarketDataClient
+from wire_protocol import PROTOCOL_JSON, PROTOCOL_BINARY
+
+CONTRACT_PREFIX = "BENCH"
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class MemorySink:
+    """
+    Stand in for Postgres, remembers when every raw row reached it
+    """
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.arrivals = []
+
+    def __call__(self, batch) -> None:
+        if self.delay:
+            time.sleep(self.delay)
+
+        visible = time.time()
+        self.arrivals.append((visible, [data[3].timestamp() for operation, data in server.iter_rows(batch) if operation == "insert_raw"]))
+
+    def latencies(self) -> tuple:
+        """ (visible times, latencies) in seconds for every row so far """
+        arrivals = list(self.arrivals)  # the writers keep appending while this runs
+        if not arrivals:
+            return np.empty(0), np.empty(0)
+
+        visible = np.concatenate([np.full(len(stamps), seen) for seen, stamps in arrivals])
+        sent = np.concatenate([np.asarray(stamps, dtype=np.float64) for _, stamps in arrivals])
+
+        return visible, visible - sent
+
+
+class PostgresPoller:
+    """
+    Watches raw_contracts for the benchmark's rows
+    Every contract is written by one writer in order, so a per contract datetime watermark finds each new row exactly once
+    """
+
+    def __init__(self, contracts: list, poll_interval: float = 0.01):
+        self.contracts = contracts
+        self.poll_interval = poll_interval
+        self.visible = []
+        self.sent = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def clear(self) -> None:
+        conn = server.DatabaseUtility.database_connect(server.DB_PARAMS['dbname'], server.DB_PARAMS['user'], server.DB_PARAMS['password'])
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM raw_contracts WHERE contract_id LIKE %s", (CONTRACT_PREFIX + "%",))
+        conn.commit()
+        conn.close()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='benchmark_poller', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        conn = server.DatabaseUtility.database_connect(server.DB_PARAMS['dbname'], server.DB_PARAMS['user'], server.DB_PARAMS['password'])
+        conn.autocommit = True
+        watermarks = {contract: 0 for contract in self.contracts}
+        query = """
+            SELECT r.contract_id, (EXTRACT(EPOCH FROM r.datetime) * 1000000)::bigint
+            FROM raw_contracts r
+            JOIN (SELECT unnest(%s::text[]) AS contract_id, unnest(%s::bigint[]) AS since) w ON r.contract_id = w.contract_id
+            WHERE r.datetime > timestamptz 'epoch' + w.since * interval '1 microsecond'
+        """
+
+        with conn.cursor() as cur:
+            while not self._stop.is_set():
+                cur.execute(query, (list(watermarks), list(watermarks.values())))
+                rows = cur.fetchall()
+                seen = time.time()
+
+                for contract_id, epoch_us in rows:
+                    watermarks[contract_id] = max(watermarks[contract_id], epoch_us)
+                self.sent.extend(epoch_us / 1e6 for _, epoch_us in rows)
+                self.visible.extend([seen] * len(rows))
+
+                time.sleep(self.poll_interval)
+        conn.close()
+
+    def latencies(self) -> tuple:
+        visible = np.asarray(self.visible, dtype=np.float64)
+        return visible, visible - np.asarray(self.sent, dtype=np.float64)
+
+
+def run_client(index: int, host: str, port: int, rate: float, duration: float, protocol: str, buffered: bool, results: list) -> None:
+    """
+    Send ticks for one contract at rate messages per second (0 = as fast as possible) for duration seconds
+    Sending is paced in 10ms slices so a slow slice catches up in the next one
+    """
+    client = MarketDataClient(host, port, protocol=protocol, buffered=buffered)
+    contract_id = f"{CONTRACT_PREFIX}{index}"
+    start = time.time()
+    end = start + duration
+    last_us = 0
+    sent = 0
+
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+
+        target = int((now - start) * rate) + 1 if rate else sent + 1000
+        while sent < target:
+            last_us = max(int(time.time() * 1_000_000), last_us + 1)
+            if client.send_tick_data(contract_id, CONTRACT_PREFIX, 100.0 + sent % 100, timestamp=last_us,
+                                     num_trades=1, bid_volume=1, ask_volume=0):
+                sent += 1
+            else:
+                break
+
+        if rate:
+            time.sleep(max(0.0, 0.01 - (time.time() - now)))
+
+    if buffered:
+        client.close()
+    else:
+        client.disconnect()
+
+    results[index] = {"sent": sent, "seconds": time.time() - start, **client.stats()}
+
+
+def report(results: list, visible: np.ndarray, latencies: np.ndarray, started: float) -> None:
+    """ Print throughput and the latency percentiles """
+    sent = sum(result["sent"] for result in results)
+    send_seconds = max(result["seconds"] for result in results)
+
+    print(f"clients:            {len(results)}")
+    print(f"sent:               {sent:,} in {send_seconds:.2f}s ({sent / send_seconds:,.0f} msg/s)")
+    print(f"dropped by clients: {sum(result['messages_dropped'] for result in results):,}")
+    print(f"visible:            {len(latencies):,} ({len(latencies) / max(sent, 1):.1%})")
+
+    if len(latencies):
+        span = visible.max() - started
+        print(f"sustained:          {len(latencies) / span:,.0f} rows/s (first send to last row visible, {span:.2f}s)")
+        values = np.percentile(latencies, PERCENTILES) * 1000
+        print("latency ms:         " + "  ".join(f"p{p:g}={v:,.1f}" for p, v in zip(PERCENTILES, values))
+              + f"  max={latencies.max() * 1000:,.1f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=4, help="Number of concurrent clients, one contract each")
+    parser.add_argument("--rate", type=float, default=1000, help="Messages per second per client, 0 = as fast as possible")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds every client sends for")
+    parser.add_argument("--protocol", choices=[PROTOCOL_JSON, PROTOCOL_BINARY], default=PROTOCOL_JSON)
+    parser.add_argument("--buffered", action="store_true", help="Use the clients' buffered mode")
+    parser.add_argument("--sink", choices=["postgres", "memory"], default="memory")
+    parser.add_argument("--sink-delay", type=float, default=0.0, help="Seconds the memory sink sleeps per batch")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio", help="Server mode when started here")
+    parser.add_argument("--writers", type=int, default=server.DB_WRITERS)
+    parser.add_argument("--port", type=int, default=5599, help="Port for the server started here")
+    parser.add_argument("--server", default=None, help="host:port of a server that's already running (postgres sink only)")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="Seconds to wait for the last rows after sending stops")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    contracts = [f"{CONTRACT_PREFIX}{i}" for i in range(args.clients)]
+
+    if args.server and args.sink == "memory":
+        raise SystemExit("--sink memory needs the server in this process, drop --server")
+
+    sink = MemorySink(args.sink_delay) if args.sink == "memory" else None
+    poller = PostgresPoller(contracts) if args.sink == "postgres" else None
+    if poller:
+        poller.clear()
+        poller.start()
+
+    if args.server:
+        host, port = args.server.rsplit(":", 1)
+        port = int(port)
+    else:
+        host, port = "127.0.0.1", args.port
+        target = server.start_async_server if args.mode == "asyncio" else server.start_server
+        threading.Thread(target=target, args=(host, port, sink), kwargs={'num_writers': args.writers},
+                         name='benchmark_server', daemon=True).start()
+        time.sleep(1)
+
+    results = [None] * args.clients
+    started = time.time()
+    clients = [
+        threading.Thread(target=run_client, args=(i, host, port, args.rate, args.duration, args.protocol, args.buffered, results))
+        for i in range(args.clients)
+    ]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+    # wait for the tail to land
+    expected = sum(result["sent"] for result in results)
+    deadline = time.time() + args.drain_timeout
+    source = sink or poller
+    while len(source.latencies()[1]) < expected and time.time() < deadline:
+        time.sleep(0.1)
+
+    if poller:
+        poller.stop()
+        poller.clear()
+
+    visible, latencies = source.latencies()
+    report(results, visible, latencies, started)
@@ -0,0 +1,208 @@
+"""
+Counters, histograms and a small text endpoint for the market data server
+
+Updates are plain dict/int increments with no locks, a count can come up a little short when two threads
+bump the same key at once, which is fine for sizing and spotting a writer falling behind
+All the work (rates, histogram lines, gauges) happens when a report is asked for
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('market_data_server')
+
+BATCH_SIZE_BUCKETS = (1, 10, 100, 500, 1_000, 5_000, 10_000, 50_000)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# the per second rates cover about this many seconds, counts are sampled at most once per SAMPLE_SECONDS
+RATE_WINDOW = 10.0
+SAMPLE_SECONDS = 1.0
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name: str, labels: str = "") -> list:
+        """
+        Cumulative bucket lines in the usual le="..." style plus _count and _sum
+        """
+        lines = []
+        cumulative = 0
+        separator = "," if labels else ""
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_count{{{labels}}} {self.count}" if labels else f"{name}_count {self.count}")
+        lines.append(f"{name}_sum{{{labels}}} {self.sum:.6f}" if labels else f"{name}_sum {self.sum:.6f}")
+
+        return lines
+
+
+class ServerMetrics:
+
+    def __init__(self, rate_window: float = RATE_WINDOW):
+        self.started = time.time()
+        self.connection_messages = defaultdict(int)
+        self.symbol_messages = defaultdict(int)
+        self.decode_errors = 0
+        self.rows_written = 0
+        self.write_errors = 0
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.insert_latency = Histogram(LATENCY_BUCKETS)
+        self.gauges = {}
+
+        # (time, connection counts, symbol counts) samples taken by report, oldest first, the rates are worked out
+        # against the newest one that is at least rate_window old, so they don't depend on who asked last
+        self.rate_window = rate_window
+        self._started_monotonic = time.monotonic()
+        self._samples = deque()
+        self._samples_lock = threading.Lock()
+
+    def record_messages(self, client_address, count: int) -> None:
+        if count:
+            self.connection_messages[client_address] += count
+
+    def record_symbol(self, symbol) -> None:
+        self.symbol_messages[symbol] += 1
+
+    def record_symbols(self, symbols) -> None:
+        for symbol, count in Counter(symbols).items():
+            self.symbol_messages[symbol] += count
+
+    def record_decode_error(self, count: int = 1) -> None:
+        self.decode_errors += count
+
+    def record_batch(self, rows: int, seconds: float) -> None:
+        self.rows_written += rows
+        self.batch_sizes.observe(rows)
+        self.insert_latency.observe(seconds)
+
+    def record_write_error(self) -> None:
+        self.write_errors += 1
+
+    def connection_closed(self, client_address) -> None:
+        self.connection_messages.pop(client_address, None)
+
+    def add_gauge(self, name: str, labels: dict, value_function) -> None:
+        """
+        This function registers a value that is only read when a report is made, e.g. a queue's qsize
+        """
+        label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+        self.gauges[f"{name}{{{label_text}}}" if label_text else name] = value_function
+
+    def report(self) -> str:
+        """
+        This function returns every metric as "name{labels} value" lines
+        The per second rates cover about the last rate_window seconds (longer if reports come further apart),
+        any number of scrapers and the periodic log can call it without skewing each other's rates
+        """
+        now = time.monotonic()
+        connections = dict(self.connection_messages)
+        symbols = dict(self.symbol_messages)
+
+        with self._samples_lock:
+            since, last_connections, last_symbols = self._rate_baseline(now)
+            if not self._samples or now - self._samples[-1][0] >= SAMPLE_SECONDS:
+                self._samples.append((now, connections, symbols))
+        elapsed = max(now - since, 1e-9)
+
+        lines = [
+            f"uptime_seconds {time.time() - self.started:.1f}",
+            f"messages_total {sum(symbols.values())}",
+            f"messages_per_second {(sum(symbols.values()) - sum(last_symbols.values())) / elapsed:.1f}",
+            f"open_connections {len(connections)}",
+        ]
+        for client_address, count in sorted(connections.items(), key=lambda item: str(item[0])):
+            client = f"{client_address[0]}:{client_address[1]}" if isinstance(client_address, tuple) else client_address
+            rate = (count - last_connections.get(client_address, 0)) / elapsed
+            lines.append(f'connection_messages_total{{client="{client}"}} {count}')
+            lines.append(f'connection_messages_per_second{{client="{client}"}} {rate:.1f}')
+        for symbol, count in sorted(symbols.items(), key=lambda item: str(item[0])):
+            rate = (count - last_symbols.get(symbol, 0)) / elapsed
+            lines.append(f'symbol_messages_total{{symbol="{symbol}"}} {count}')
+            lines.append(f'symbol_messages_per_second{{symbol="{symbol}"}} {rate:.1f}')
+
+        lines.append(f"decode_errors_total {self.decode_errors}")
+        lines.append(f"rows_written_total {self.rows_written}")
+        lines.append(f"write_errors_total {self.write_errors}")
+        lines.extend(self.batch_sizes.lines("batch_size_rows"))
+        lines.extend(self.insert_latency.lines("insert_latency_seconds"))
+
+        for name, value_function in self.gauges.items():
+            try:
+                lines.append(f"{name} {value_function()}")
+            except Exception as e:
+                logger.debug(f"Gauge {name} failed: {e}")
+
+        return "\n".join(lines) + "\n"
+
+    def _rate_baseline(self, now: float) -> tuple:
+        """ The sample the rates are measured from, samples older than it are dropped (call with _samples_lock held) """
+        while len(self._samples) > 1 and now - self._samples[1][0] >= self.rate_window:
+            self._samples.popleft()
+
+        return self._samples[0] if self._samples else (self._started_monotonic, {}, {})
+
+    def serve(self, host: str = "127.0.0.1", port: int = 9100) -> ThreadingHTTPServer:
+        """
+        This function serves report() at http://host:port/metrics from a daemon thread
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+
+                body = metrics.report().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics_http", daemon=True).start()
+        logger.info(f"Metrics at http://{host}:{port}/metrics")
+
+        return server
+
+    def log_periodically(self, interval: float) -> threading.Thread:
+        """
+        This function logs report() every interval seconds from a daemon thread, for when nothing scrapes the endpoint
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                logger.info("Stats\n" + self.report())
+
+        thread = threading.Thread(target=run, name="metrics_log", daemon=True)
+        thread.start()
+
+        return thread
+
+
+def file_size(path: str) -> int:
+    """ Size of a file or 0 if it doesn't exist, for the spool gauges """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
@@ -4,6 +4,9 @@ import time
 import datetime
 import random
 import logging
+import threading
+from collections import deque
+from wire_protocol import WireProtocol, PROTOCOL_JSON, PROTOCOL_BINARY
 
 logging.basicConfig(
     level=logging.INFO,
@@ -12,11 +15,45 @@ logging.basicConfig(
 logger = logging.getLogger('market_data_client')
 
 class MarketDataClient:
-    def __init__(self, server_host='127.0.0.1', server_port=5555):
+    def __init__(self, server_host='127.0.0.1', server_port=5555, protocol=PROTOCOL_JSON, buffered=False,
+                 flush_size=1000, flush_interval=0.05, max_pending=1_000_000, reconnect_delay=1.0):
+        """
+        protocol="binary" asks the server for length prefixed struct frames on connect (see wire_protocol),
+        a server that doesn't answer the hello keeps the connection on JSON
+
+        buffered=True makes the send functions only queue the message, a background thread sends the queue
+        in one sendall once flush_size messages are waiting or every flush_interval seconds
+        If the connection drops it reconnects every reconnect_delay seconds and resends what wasn't sent,
+        messages past max_pending waiting ones are dropped
+        The server upserts on (contract_id, datetime) / (symbol, datetime), so resending a batch that partly went out is harmless
+        """
         self.server_host = server_host
         self.server_port = server_port
+        self.protocol = protocol
+        self.active_protocol = PROTOCOL_JSON
         self.socket = None
         self.connected = False
+
+        self.buffered = buffered
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.reconnect_delay = reconnect_delay
+
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        self.bytes_sent = 0
+
+        self._received = b""
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._flush_thread = None
+
+        if buffered:
+            self._flush_thread = threading.Thread(target=self._flush_loop, name='market_data_flush', daemon=True)
+            self._flush_thread.start()
         
     def connect(self):
         """ Connect to the market data server """
@@ -25,12 +62,40 @@ class MarketDataClient:
             self.socket.connect((self.server_host, self.server_port))
             self.connected = True
             logger.info(f"Connected to server at {self.server_host}:{self.server_port}")
+            self._received = b""
+            self.active_protocol = self._negotiate() if self.protocol == PROTOCOL_BINARY else PROTOCOL_JSON
             return True
         except Exception as e:
             logger.error(f"Connection error: {e}")
             self.connected = False
             return False
     
+    def _negotiate(self, timeout=5):
+        """ Send the hello and wait for the server's hello_ack, returns the protocol to use """
+        try:
+            self.socket.sendall(WireProtocol.hello(self.protocol))
+            self.socket.settimeout(timeout)
+
+            response = b""
+            while b"\n" not in response:
+                data = self.socket.recv(4096)
+                if not data:
+                    break
+                response += data
+
+            # anything after the ack (e.g. an update already on its way) stays for updates() to read
+            line, _, self._received = response.partition(b"\n")
+            ack = json.loads(line.decode('utf-8'))
+            protocol = ack.get('protocol', PROTOCOL_JSON)
+        except (socket.timeout, ValueError) as e:
+            logger.warning(f"No protocol answer from the server ({e}), staying on JSON")
+            protocol = PROTOCOL_JSON
+        finally:
+            self.socket.settimeout(None)
+
+        logger.info(f"Using the {protocol} protocol")
+        return protocol
+
     def disconnect(self):
         """ Disconnect from the server """
         if self.socket:
@@ -38,69 +103,226 @@ class MarketDataClient:
             self.socket = None
             self.connected = False
             logger.info("Disconnected from server")
+
+    def close(self, timeout=10):
+        """ Send whatever is still buffered (waiting at most timeout seconds) and disconnect """
+        if self._flush_thread is not None:
+            self._stop.set()
+            self._wakeup.set()
+            self._flush_thread.join(timeout)
+            self._flush_thread = None
+
+            with self._lock:
+                if self._pending:
+                    logger.warning(f"Dropping {len(self._pending)} unsent messages")
+                self.messages_dropped += len(self._pending)
+                self._pending.clear()
+
+        self.disconnect()
+
+    def stats(self):
+        """ Counters for what has been sent, dropped and is still waiting """
+        return {
+            'messages_sent': self.messages_sent,
+            'messages_dropped': self.messages_dropped,
+            'bytes_sent': self.bytes_sent,
+            'pending': len(self._pending),
+        }
     
     def send_tick_data(self, contract_id, symbol, price, timestamp=None, expiry_date=None, 
                       num_trades=0, bid_volume=0, ask_volume=0):
         """ Send tick data to the server """
+        if self.buffered:
+            if timestamp is None:
+                timestamp = datetime.datetime.now(datetime.timezone.utc)
+            return self._enqueue('raw_data', (contract_id, symbol, price, timestamp, expiry_date, num_trades, bid_volume, ask_volume))
+
         if not self.connected:
             if not self.connect():
                 return False
         
         if timestamp is None:
-            timestamp = datetime.datetime.now().isoformat()
-        
-        message = {
-            'type': 'raw_data',
-            'contract_id': contract_id,
-            'symbol': symbol,
-            'price': price,
-            'timestamp': timestamp,
-            'num_trades': num_trades,
-            'bid_volume': bid_volume,
-            'ask_volume': ask_volume
-        }
-        
-        if expiry_date:
-            message['expiry_date'] = expiry_date
-        
-        return self._send_message(message)
+            if self.active_protocol == PROTOCOL_BINARY:
+                timestamp = datetime.datetime.now(datetime.timezone.utc)
+            else:
+                timestamp = datetime.datetime.now().isoformat()
+
+        return self._send_bytes(self._encode('raw_data', (contract_id, symbol, price, timestamp, expiry_date, num_trades, bid_volume, ask_volume)))
     
     def send_continuous_data(self, symbol, price, active_contract_id, timestamp=None, 
                             volume=0, num_trades=0, bid_volume=0, ask_volume=0, rollover_flag=False):
         """ Send continuous contract data to the server """
+        if self.buffered:
+            if timestamp is None:
+                timestamp = datetime.datetime.now(datetime.timezone.utc)
+            return self._enqueue('continuous_data', (symbol, price, active_contract_id, timestamp, volume, num_trades, bid_volume, ask_volume, rollover_flag))
+
         if not self.connected:
             if not self.connect():
                 return False
         
         if timestamp is None:
-            timestamp = datetime.datetime.now().isoformat()
-        
-        message = {
-            'type': 'continuous_data',
-            'symbol': symbol,
-            'price': price,
-            'timestamp': timestamp,
-            'volume': volume,
-            'num_trades': num_trades,
-            'bid_volume': bid_volume,
-            'ask_volume': ask_volume,
-            'active_contract_id': active_contract_id,
-            'rollover_flag': rollover_flag
-        }
-        
-        return self._send_message(message)
-    
-    def _send_message(self, message):
-        """ Encode and send a message to the server """
+            if self.active_protocol == PROTOCOL_BINARY:
+                timestamp = datetime.datetime.now(datetime.timezone.utc)
+            else:
+                timestamp = datetime.datetime.now().isoformat()
+
+        return self._send_bytes(self._encode('continuous_data', (symbol, price, active_contract_id, timestamp, volume, num_trades, bid_volume, ask_volume, rollover_flag)))
+
+    def subscribe(self, contract_ids=None, symbols=None, msg_type='subscribe'):
+        """
+        Ask the server for live updates (latest tick plus rolling bar) of some contracts (raw ticks) and/or symbols
+        (continuous ticks), read them with updates()
+        msg_type='snapshot' asks for the current values once, 'unsubscribe' stops them (everything if no keys are given)
+        The control messages are JSON, so this needs a connection that stayed on the JSON protocol
+        """
+        if not self.connected and not self.connect():
+            return False
+        if self.active_protocol != PROTOCOL_JSON:
+            logger.error(f"Can't {msg_type} on a {self.active_protocol} connection, use a separate JSON client")
+            return False
+
+        message = {'type': msg_type, 'contract_ids': list(contract_ids or []), 'symbols': list(symbols or [])}
+        return self._send_bytes((json.dumps(message) + "\n").encode('utf-8'), 0)
+
+    def updates(self, timeout=None):
+        """
+        Yield the server's updates as dicts as they arrive, stops when nothing comes for timeout seconds
+        (never with timeout=None) or the connection closes
+        """
+        self.socket.settimeout(timeout)
         try:
-            json_data = json.dumps(message) + "\n"
-            self.socket.sendall(json_data.encode('utf-8'))
+            while True:
+                while b"\n" in self._received:
+                    line, self._received = self._received.split(b"\n", 1)
+                    yield json.loads(line)
+
+                data = self.socket.recv(65536)
+                if not data:
+                    return
+                self._received += data
+        except socket.timeout:
+            return
+        finally:
+            if self.socket:
+                self.socket.settimeout(None)
+
+    def _encode(self, msg_type, fields):
+        """ Encode one message in the connection's protocol, fields are in the send function's argument order """
+        if self.active_protocol == PROTOCOL_BINARY:
+            if msg_type == 'raw_data':
+                return WireProtocol.encode_raw(*fields)
+            return WireProtocol.encode_continuous(*fields)
+
+        if msg_type == 'raw_data':
+            contract_id, symbol, price, timestamp, expiry_date, num_trades, bid_volume, ask_volume = fields
+            message = {
+                'type': 'raw_data',
+                'contract_id': contract_id,
+                'symbol': symbol,
+                'price': price,
+                'timestamp': timestamp,
+                'num_trades': num_trades,
+                'bid_volume': bid_volume,
+                'ask_volume': ask_volume
+            }
+            if expiry_date:
+                message['expiry_date'] = expiry_date if isinstance(expiry_date, str) else expiry_date.isoformat()
+        else:
+            symbol, price, active_contract_id, timestamp, volume, num_trades, bid_volume, ask_volume, rollover_flag = fields
+            message = {
+                'type': 'continuous_data',
+                'symbol': symbol,
+                'price': price,
+                'timestamp': timestamp,
+                'volume': volume,
+                'num_trades': num_trades,
+                'bid_volume': bid_volume,
+                'ask_volume': ask_volume,
+                'active_contract_id': active_contract_id,
+                'rollover_flag': rollover_flag
+            }
+
+        if isinstance(message['timestamp'], datetime.datetime):
+            message['timestamp'] = message['timestamp'].isoformat()
+
+        return (json.dumps(message) + "\n").encode('utf-8')
+
+    def _send_bytes(self, data, num_messages=1):
+        """ Send already encoded bytes to the server """
+        try:
+            self.socket.sendall(data)
+            self.messages_sent += num_messages
+            self.bytes_sent += len(data)
             return True
         except Exception as e:
             logger.error(f"Send error: {e}")
             self.connected = False
             return False
 
+    def _enqueue(self, msg_type, fields):
+        """ Buffered mode, queue a message for the flush thread """
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.messages_dropped += 1
+                return False
+            self._pending.append((msg_type, fields))
+            if len(self._pending) >= self.flush_size:
+                self._wakeup.set()
+        return True
+
+    def _flush_loop(self):
+        """ Background thread for buffered mode, sends the queue on size/time and reconnects when the send fails """
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if not self._flush_pending():
+                self._stop.wait(self.reconnect_delay)
+
+        # one last go at whatever close() is waiting on
+        self._flush_pending()
+
+    def _flush_pending(self):
+        """ Send everything queued flush_size messages at a time, returns False if the connection is down """
+        while True:
+            with self._lock:
+                batch = [self._pending.popleft() for _ in range(min(self.flush_size, len(self._pending)))]
+            if not batch:
+                return True
+
+            if self.connected or self.connect():
+                # encoded here so a reconnect that lands on a different protocol still sends the right thing
+                data, sent = self._encode_batch(batch)
+                if not sent or self._send_bytes(data, sent):
+                    continue
+                self.disconnect()
+
+                # only what encoded goes back, the bad messages were counted as dropped already
+                batch = [message for message in batch if message is not None]
+
+            # put the batch back at the front so it goes out first and in order after reconnecting
+            with self._lock:
+                self._pending.extendleft(reversed(batch))
+            return False
+
+    def _encode_batch(self, batch):
+        """
+        Encode a batch for one sendall, a message that can't be encoded (a string too long for its binary field,
+        a value of the wrong type) is logged and dropped, and set to None in batch so it isn't retried
+        Returns the bytes and how many messages they hold
+        """
+        parts = []
+        for i, (msg_type, fields) in enumerate(batch):
+            try:
+                parts.append(self._encode(msg_type, fields))
+            except Exception as e:
+                logger.error(f"Dropping a {msg_type} message that can't be encoded: {e}")
+                batch[i] = None
+                with self._lock:
+                    self.messages_dropped += 1
+
+        return b"".join(parts), len(parts)
+
 # example usage
 if __name__ == "__main__":
     client = MarketDataClient()
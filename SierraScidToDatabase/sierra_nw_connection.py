@@ -1,13 +1,22 @@
 import socket
 import threading
+import asyncio
+import argparse
 import json
 import datetime
 import time
 import logging
 import os
 import sys
-from database_util import DatabaseUtility
-from queue import Queue
+import glob
+import psycopg2
+from database_util import DatabaseUtility, TABLE_COLUMNS, CONFLICT_KEYS, PARTITION_MONTHS_AHEAD
+from psycopg2.extras import execute_values
+from wire_protocol import WireProtocol, PROTOCOL_JSON, PROTOCOL_BINARY, MSG_RAW, MSG_CONTINUOUS
+from ingest_queue import SpooledQueue
+from server_metrics import ServerMetrics, file_size
+from tick_batch import TickBatch, partition_of
+from live_cache import LiveCache, Subscriber
 from dotenv import load_dotenv
 
 load_dotenv('./keys_and_secrets.env')
@@ -15,6 +24,7 @@ DB_NAME = os.getenv('sql_name')
 DB_USER = os.getenv('sql_username')
 DB_PW = os.getenv('sql_password')
 DB_CREATED = os.getenv('db_created')
+DB_PARTITIONED = os.getenv('db_partitioned', 'false') == 'true'
 
 logging.basicConfig(
     level=logging.INFO,
@@ -30,88 +40,261 @@ DB_PARAMS = {
     'port': '5432',
 }
 
-db_queue = Queue()
+# db_worker flushes once this many items are waiting or the oldest one has waited this many seconds
+DB_BATCH_MAX_ROWS = int(os.getenv('db_batch_max_rows', 5000))
+DB_BATCH_MAX_LATENCY = float(os.getenv('db_batch_max_latency', 0.05))
 
-# double check the db connection
-if DB_CREATED == 'false':
-    DatabaseUtility.create_db(DB_NAME, DB_USER, DB_PW)
-    DatabaseUtility.create_tables(DB_NAME, DB_USER, DB_PW)
-    sys.exit("Attempted to create database and tables, doublecheck...")
-db_connection = DatabaseUtility.database_connect(DB_PARAMS['dbname'], DB_PARAMS['user'], DB_PARAMS['password'])
+# number of writer threads (and pooled connections), rows are split between them by contract_id/symbol
+DB_WRITERS = int(os.getenv('db_writers', 4))
 
-def db_worker() -> None:
-    """ Worker that handles database operations from the queue """
-    cur = db_connection.cursor()
+# each writer's in memory queue holds this many items, past that the socket readers wait up to
+# db_enqueue_timeout seconds and then everything spills to a spool file in spool_dir until the writer catches up
+DB_QUEUE_SIZE = int(os.getenv('db_queue_size', 100_000))
+DB_ENQUEUE_TIMEOUT = float(os.getenv('db_enqueue_timeout', 0.5))
+SPOOL_DIR = os.getenv('spool_dir', './spool')
 
-    while True:
-        batch = []
-        batch.append(db_queue.get())
+# metrics_port serves the stats at http://127.0.0.1:<port>/metrics, stats_interval logs them every N seconds, 0 turns either off
+METRICS_PORT = int(os.getenv('metrics_port', 0))
+STATS_INTERVAL = float(os.getenv('stats_interval', 0))
+
+# rolling bar length in the last value cache, and how many updates a subscriber can fall behind before the oldest are dropped
+LIVE_BAR_SECONDS = int(os.getenv('live_bar_seconds', 60))
+SUBSCRIBER_BUFFER = int(os.getenv('subscriber_buffer', 10_000))
+
+# JSON messages a connection can send to read the cache instead of writing ticks
+CONTROL_TYPES = ("subscribe", "unsubscribe", "snapshot")
+
+OPERATION_TABLES = {
+    "insert_raw": "raw_contracts",
+    "insert_continuous": "continuous_contracts",
+}
 
-        # try to get more items for batch operation
+# one queue per writer, filled by enqueue and set up by start_writers
+db_queues = []
+db_pool = None
+metrics = ServerMetrics()
+live_cache = LiveCache(LIVE_BAR_SECONDS)
+metrics.add_gauge('subscribers', {}, lambda: len(live_cache.live_subscribers()))
+metrics.add_gauge('subscriber_dropped_total', {}, live_cache.dropped_total)
+
+def start_writers(num_writers=None, sink=None, put_timeout=None, queue_size=None, spool_dir=None,
+                  max_rows=None, max_latency=None) -> None:
+    """
+    Open the connection pool and start one db_worker thread (with its own queue and connection) per writer
+    sink replaces the database with a function that gets every batch (a list of (operation, row)), see server_benchmark
+    put_timeout is how long a put waits on a full queue before spooling, 0 for producers on an event loop
+    Anything left as None comes from the settings at the top (DB_WRITERS, DB_QUEUE_SIZE, SPOOL_DIR, ...)
+    """
+    global db_pool
+
+    num_writers = num_writers or DB_WRITERS
+    put_timeout = DB_ENQUEUE_TIMEOUT if put_timeout is None else put_timeout
+    queue_size = queue_size or DB_QUEUE_SIZE
+    spool_dir = spool_dir or SPOOL_DIR
+    if sink is None:
+        db_pool = DatabaseUtility.connection_pool(DB_PARAMS['dbname'], DB_PARAMS['user'], DB_PARAMS['password'],
+                                                  maxconn=num_writers, host=DB_PARAMS['host'], port=DB_PARAMS['port'])
+
+        # with the partitioned schema, have the coming months ready so a month rollover doesn't create one mid stream
+        conn = db_pool.getconn()
         try:
-            while (len(batch) < 100):
-                item = db_queue.get_nowait()
-                batch.append(item)
-        except:
-            # queue empty or not enough items
-            pass
+            today = datetime.date.today()
+            for table_name in OPERATION_TABLES.values():
+                DatabaseUtility.ensure_partitions(conn, table_name, today, DatabaseUtility.add_months(today, PARTITION_MONTHS_AHEAD))
+        finally:
+            db_pool.putconn(conn)
+
+    for i in range(num_writers):
+        spool_path = os.path.join(spool_dir, f'writer_{i}.spool')
+        db_queues.append(SpooledQueue(spool_path, queue_size, put_timeout))
+        metrics.add_gauge('queue_depth', {'writer': i}, db_queues[i].queue.qsize)
+        metrics.add_gauge('spool_items', {'writer': i}, lambda queue=db_queues[i]: queue.spooled)
+        metrics.add_gauge('spool_bytes', {'writer': i}, lambda path=spool_path: file_size(path))
+        threading.Thread(target=db_worker, args=(db_queues[i], sink, max_rows, max_latency), name=f'db_worker_{i}', daemon=True).start()
+
+    logger.info(f'Started {num_writers} database writers')
+
+    # spools only get replayed by the writer with the same number
+    for spool_path in glob.glob(os.path.join(spool_dir, 'writer_*.spool')):
+        writer = int(os.path.basename(spool_path)[len('writer_'):-len('.spool')])
+        if writer >= num_writers:
+            logger.warning(f'{spool_path} was left by a run with more writers, restart with --writers {writer + 1} to replay it')
+
+def enqueue(operation, data) -> None:
+    """
+    Queue a row for the writers
+    Rows go to a writer by their first column (contract_id for raw rows, symbol for continuous rows),
+    so every row for one contract/symbol is written by the same thread in the order it arrived
+    """
+    metrics.record_symbol(data[1] if operation == "insert_raw" else data[0])
+    db_queues[partition_of(data[0], len(db_queues))].put((operation, data))
+
+    # the live cache is best effort, a tick it can't take is still on its way to the database
+    try:
+        live_cache.update_row(operation, data)
+    except Exception as e:
+        logger.error(f"Live cache update failed for {data[:2]}: {e}")
+
+def enqueue_batch(batch) -> None:
+    """ Queue a TickBatch, split so every writer gets its part as one item (same per key ordering as enqueue) """
+    metrics.record_symbols(batch.symbols())
+    for partition, part in batch.partition(len(db_queues)).items():
+        db_queues[partition].put(part)
+
+    try:
+        live_cache.update(batch)
+    except Exception as e:
+        logger.error(f"Live cache update failed for a batch of {batch.num_rows} rows: {e}")
+
+def iter_rows(batch):
+    """ (operation, row) for every row in a list of queue items, which are either single rows or TickBatches """
+    for item in batch:
+        if isinstance(item, TickBatch):
+            for row in item.rows():
+                yield item.operation, row
+        else:
+            yield item
+
+def db_worker(db_queue, sink=None, max_rows=None, max_latency=None) -> None:
+    """
+    Worker that handles database operations from its queue
+
+    Items are collected until max_rows are waiting or max_latency seconds have passed since the first one,
+    then every operation type is written as one multi row upsert (execute_values) instead of one statement per row
+    """
+    max_rows = max_rows or DB_BATCH_MAX_ROWS
+    max_latency = DB_BATCH_MAX_LATENCY if max_latency is None else max_latency
+    db_connection = None
+
+    while True:
+        batch = db_queue.get_batch(max_rows, max_latency)
+        num_rows = sum(getattr(item, 'num_rows', 1) for item in batch)
+
+        if sink is not None:
+            start = time.perf_counter()
+            try:
+                sink(batch)
+                metrics.record_batch(num_rows, time.perf_counter() - start)
+            except Exception as e:
+                metrics.record_write_error()
+                logger.error(f'Sink error, dropped {num_rows} rows: {e}')
+            continue
+
+        # the same batch is retried until it's written, newer rows pile up behind it (and spill to the spool) meanwhile
+        while True:
+            try:
+                if db_connection is None:
+                    db_connection = db_pool.getconn()
+
+                start = time.perf_counter()
+                with db_connection.cursor() as cur:
+                    write_batch(cur, batch)
+                db_connection.commit()
+                metrics.record_batch(num_rows, time.perf_counter() - start)
+                break
+
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                logger.error(f'Database connection error, retrying {num_rows} rows: {e}')
+                metrics.record_write_error()
+                db_connection = reset_connection(db_connection)
+                time.sleep(1)
+
+            except Exception as e:
+                metrics.record_write_error()
+                if db_connection is None:
+                    # getconn itself failed (e.g. the pool is exhausted), nothing was written, just try again
+                    logger.error(f'No database connection, retrying {num_rows} rows: {e}')
+                    time.sleep(1)
+                    continue
+
+                # bad data, retrying won't help, so write the rows one at a time and drop the ones that fail
+                logger.error(f'Database operation error, writing {num_rows} rows one by one: {e}')
+                try:
+                    db_connection.rollback()
+                    write_rows_individually(db_connection, batch)
+                    break
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                    # lost the connection on the way, swap it for a fresh one and retry the batch
+                    logger.error(f'Database connection error, retrying {num_rows} rows: {e}')
+                    db_connection = reset_connection(db_connection)
+                    time.sleep(1)
 
-        # process the batchj
+def reset_connection(db_connection):
+    """
+    Roll back a connection after a failed write, one that can't roll back (or is gone) goes back to the pool closed
+    Returns the connection to keep using, None when the next try should take a fresh one from the pool
+    """
+    if db_connection is None:
+        return None
+
+    if not db_connection.closed:
         try:
-            for operation, data in batch:
-                if operation == "insert_raw":
-                    cur.execute("""
-                        INSERT INTO raw_contracts 
-                        (contract_id, symbol, expiry_date, datetime, price, num_trades, bid_volume, ask_volume)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (contract_id, datetime) DO UPDATE SET
-                        price = EXCLUDED.price,
-                        num_trades = EXCLUDED.num_trades,
-                        bid_volume = EXCLUDED.bid_volume,
-                        ask_volume = EXCLUDED.ask_volume
-                    """, data)
-                elif operation == "insert_continuous":
-                    cur.execute("""
-                        INSERT INTO continuous_contracts 
-                        (symbol, datetime, price, volume, num_trades, bid_volume, ask_volume, active_contract_id, rollover_flag)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (symbol, datetime) DO UPDATE SET
-                        price = EXCLUDED.price,
-                        volume = EXCLUDED.volume,
-                        num_trades = EXCLUDED.num_trades,
-                        bid_volume = EXCLUDED.bid_volume,
-                        ask_volume = EXCLUDED.ask_volume,
-                        active_contract_id = EXCLUDED.active_contract_id,
-                        rollover_flag = EXCLUDED.rollover_flag
-                    """, data)
-            
-            db_connection.commit()
+            db_connection.rollback()
+            return db_connection
+        except psycopg2.Error as e:
+            logger.error(f'Rollback failed, replacing the connection: {e}')
 
-            for _ in range(len(batch)):
-                db_queue.task_done()
+    try:
+        db_pool.putconn(db_connection, close=True)
+    except Exception as e:
+        logger.error(f'Could not return a broken connection to the pool: {e}')
+    return None
 
+def write_rows_individually(db_connection, batch) -> None:
+    """ Fallback for a batch the database rejected, every row gets its own transaction """
+    for item in iter_rows(batch):
+        try:
+            with db_connection.cursor() as cur:
+                write_batch(cur, [item])
+            db_connection.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            raise
         except Exception as e:
-            logger.error(f'Database operation error: {e}')
             db_connection.rollback()
+            metrics.record_write_error()
+            logger.error(f'Dropping row {item}: {e}')
 
-            for item in batch:
-                db_queue.put(item)
-            
-            for _ in range(len(batch)):
-                db_queue.task_done()
-            
-            time.sleep(1)
+def write_batch(cur, batch) -> None:
+    """ Group a batch of queue items by operation and upsert each group with a single statement """
+    groups = {}
+    for operation, data in iter_rows(batch):
+        if operation not in OPERATION_TABLES:
+            logger.warning(f'Unknown database operation: {operation}')
+            continue
+        groups.setdefault(operation, []).append(data)
+
+    # partitions for every month in the batch come first, creating one commits
+    for operation, rows in groups.items():
+        table_name = OPERATION_TABLES[operation]
+        if DatabaseUtility.is_partitioned(cur.connection, table_name):
+            datetime_index = TABLE_COLUMNS[table_name].index("datetime")
+            # UTC months, a tick just before midnight at a non UTC offset can already be in the next month's partition
+            months = {DatabaseUtility.partition_month(row[datetime_index]) for row in rows}
+            DatabaseUtility.ensure_partitions(cur.connection, table_name, min(months), max(months))
+
+    for operation, rows in groups.items():
+        table_name = OPERATION_TABLES[operation]
+
+        # one statement can't update the same row twice, so only the latest row per conflict key is kept
+        key_index = [TABLE_COLUMNS[table_name].index(column) for column in CONFLICT_KEYS[table_name]]
+        rows = list({tuple(row[i] for i in key_index): row for row in rows}.values())
+
+        execute_values(cur, DatabaseUtility.upsert_sql(table_name, "VALUES %s"), rows, page_size=len(rows))
+        logger.debug(f'Wrote {len(rows)} rows to {table_name}')
 
 def handle_client(client_socket, client_address):
     """Handle incoming client connections"""
     logger.info(f"Connection established with {client_address}")
     
+    subscriber = Subscriber(SUBSCRIBER_BUFFER)
+    send_lock = threading.Lock()
     try:
-        buffer = b""
+        buffer = bytearray()
+        protocol = PROTOCOL_JSON
         while True:
             try:
                 client_socket.settimeout(30)
-                data = client_socket.recv(4096)
+                data = client_socket.recv(65536)
                 
                 if not data:
                     logger.info(f"Client {client_address} closed connection (empty data)")
@@ -123,21 +306,18 @@ def handle_client(client_socket, client_address):
                 logger.debug(f"Buffer size now: {len(buffer)} bytes")
                 
                 # process complete messages
-                while b"\n" in buffer:
-                    msg_bytes, buffer = buffer.split(b"\n", 1)
-                    logger.debug(f"Processing message of size {len(msg_bytes)} bytes")
-                    
-                    try:
-                        msg_data = json.loads(msg_bytes.decode('utf-8'))
-                        logger.debug(f"JSON parsed successfully: {msg_data.get('type', 'unknown')} message")
-                        
-                        process_message(msg_data)
-                        logger.debug(f"Message processed successfully")
-                        
-                    except json.JSONDecodeError as je:
-                        logger.warning(f"Invalid JSON received from {client_address}: {je}, message: {msg_bytes[:100]}...")
-                    except Exception as e:
-                        logger.error(f"Error processing message from {client_address}: {e}")
+                protocol, reply = consume_buffer(buffer, protocol, client_address, subscriber)
+                if reply:
+                    with send_lock:
+                        client_socket.sendall(reply)
+
+                # the first subscribe/snapshot gets the connection a thread that sends it the updates
+                if subscriber.wakeup is None and (subscriber.keys or subscriber.updates):
+                    wake = threading.Event()
+                    subscriber.wakeup = wake.set
+                    threading.Thread(target=send_updates, args=(client_socket, subscriber, wake, send_lock, client_address),
+                                     name=f'updates_{client_address[1]}', daemon=True).start()
+                    wake.set()
             
             except socket.timeout:
                 logger.debug(f"Socket timeout for {client_address}, continuing...")
@@ -152,9 +332,259 @@ def handle_client(client_socket, client_address):
     except Exception as e:
         logger.error(f"Error handling client {client_address}: {e}")
     finally:
+        live_cache.close(subscriber)
         client_socket.close()
+        metrics.connection_closed(client_address)
         logger.info(f"Connection closed with {client_address}")
 
+def send_updates(client_socket, subscriber, wake, send_lock, client_address) -> None:
+    """
+    Sender thread for a subscribed connection, everything pushed since the last send goes out in one sendall
+    A client that doesn't read blocks only this thread, its updates keep piling into (and falling off) its bounded buffer
+    """
+    try:
+        while True:
+            wake.wait()
+            wake.clear()
+            if subscriber.closed:
+                break
+
+            updates = subscriber.drain()
+            if updates:
+                data = LiveCache.encode(updates)
+                with send_lock:
+                    client_socket.sendall(data)
+    except OSError as e:
+        logger.warning(f"Stopped sending updates to {client_address}: {e}")
+        live_cache.close(subscriber)
+
+    if subscriber.dropped:
+        logger.warning(f"{client_address} fell behind and missed {subscriber.dropped} updates")
+
+async def send_updates_async(writer, subscriber, wake, client_address) -> None:
+    """ asyncio version of send_updates, drain() waits on a slow client while the bounded buffer takes the overflow """
+    try:
+        while True:
+            await wake.wait()
+            wake.clear()
+            if subscriber.closed:
+                break
+
+            updates = subscriber.drain()
+            if updates:
+                writer.write(LiveCache.encode(updates))
+                await writer.drain()
+    except (ConnectionError, OSError) as e:
+        logger.warning(f"Stopped sending updates to {client_address}: {e}")
+        live_cache.close(subscriber)
+
+    if subscriber.dropped:
+        logger.warning(f"{client_address} fell behind and missed {subscriber.dropped} updates")
+
+def consume_buffer(buffer, protocol, client_address, subscriber=None):
+    """
+    Process every complete message in buffer (a bytearray, the processed bytes are cut off the front in place)
+    Connections start on newline delimited JSON and switch to binary frames after a hello (see wire_protocol)
+
+    All complete lines (or frames) are split off in one go and decoded together into TickBatches,
+    so a burst costs one decode and one queue put per writer instead of one per message
+
+    JSON connections can also send subscribe/unsubscribe/snapshot messages (see handle_control), their updates
+    are pushed onto subscriber and sent by the connection's sender
+
+    Returns the protocol the connection is on now and the bytes to send back to the client
+    """
+    reply = b""
+    handled = 0
+
+    if protocol == PROTOCOL_JSON:
+        end = buffer.rfind(b"\n")
+        if end < 0:
+            return protocol, reply
+
+        chunk = bytes(buffer[:end])
+        del buffer[:end + 1]
+        lines = chunk.split(b"\n")
+
+        hello_at = None
+        if b'"hello"' in chunk:
+            hello_at = next((i for i, line in enumerate(lines) if is_hello(line)), None)
+
+        json_lines = lines if hello_at is None else lines[:hello_at]
+        if subscriber is not None and (b'subscribe"' in chunk or b'"snapshot"' in chunk):
+            json_lines = [line for line in json_lines if not handle_control(line, subscriber, client_address)]
+        handled += process_json_lines(json_lines, client_address)
+
+        if hello_at is not None:
+            protocol = WireProtocol.negotiate(json.loads(lines[hello_at]))
+            reply += WireProtocol.hello_ack(protocol)
+            logger.info(f"Client {client_address} is using the {protocol} protocol")
+
+            # whatever came after the hello belongs to the new protocol, put it back in front of the unread bytes
+            if hello_at + 1 < len(lines):
+                buffer[:0] = b"\n".join(lines[hello_at + 1:]) + b"\n"
+
+    if protocol == PROTOCOL_BINARY and buffer:
+        frames, leftover = WireProtocol.split_frames(bytes(buffer))
+        buffer[:] = leftover
+        handled += process_frames(frames, client_address)
+
+    metrics.record_messages(client_address, handled)
+    return protocol, reply
+
+def is_hello(line) -> bool:
+    if b'"hello"' not in line:
+        return False
+    try:
+        return json.loads(line).get('type') == 'hello'
+    except (ValueError, AttributeError):
+        return False
+
+def handle_control(line, subscriber, client_address) -> bool:
+    """
+    This function handles a line if it's a control message, returns False for anything else (i.e. a tick)
+        {"type": "subscribe", "contract_ids": [...], "symbols": [...]} -> the current values now and every update after
+        {"type": "unsubscribe", ...} -> stop those keys, or everything when none are given
+        {"type": "snapshot", ...} -> the current values once
+    Raw ticks are cached by contract_id and continuous ticks by symbol
+    """
+    if b'subscribe"' not in line and b'"snapshot"' not in line:
+        return False
+    try:
+        message = json.loads(line)
+    except ValueError:
+        return False
+    if not isinstance(message, dict) or message.get('type') not in CONTROL_TYPES:
+        return False
+
+    keys = list(message.get('contract_ids') or []) + list(message.get('symbols') or [])
+    if message['type'] == 'subscribe':
+        live_cache.subscribe(subscriber, keys)
+        logger.info(f"{client_address} subscribed to {keys}")
+    elif message['type'] == 'unsubscribe':
+        live_cache.unsubscribe(subscriber, keys or None)
+        logger.info(f"{client_address} unsubscribed from {keys or 'everything'}")
+    else:
+        live_cache.snapshot(subscriber, keys)
+
+    return True
+
+def process_json_lines(lines, client_address) -> int:
+    """ Decode a list of JSON lines into TickBatches and queue them, returns how many lines there were """
+    if not lines:
+        return 0
+
+    try:
+        batches, bad = TickBatch.from_json_lines(lines)
+    except Exception as e:
+        # a value the batch decode choked on (e.g. a bad timestamp), go line by line so only that message is lost
+        logger.debug(f"Batch decode failed ({e}), decoding {len(lines)} lines one at a time")
+        for msg_bytes in lines:
+            handle_message_bytes(msg_bytes, client_address)
+        return len(lines)
+
+    if bad:
+        metrics.record_decode_error(bad)
+        logger.warning(f"{bad} invalid or unknown messages from {client_address}")
+    for batch in batches:
+        enqueue_batch(batch)
+
+    return len(lines)
+
+def process_frames(frames, client_address) -> int:
+    """ Binary counterpart of process_json_lines """
+    if not frames:
+        return 0
+
+    try:
+        batches, bad = TickBatch.from_frames(frames)
+    except Exception as e:
+        logger.debug(f"Batch decode failed ({e}), decoding {len(frames)} frames one at a time")
+        for msg_type, body in frames:
+            process_frame(msg_type, body, client_address)
+        return len(frames)
+
+    if bad:
+        metrics.record_decode_error(bad)
+        logger.warning(f"{bad} frames of an unknown type from {client_address}")
+    for batch in batches:
+        enqueue_batch(batch)
+
+    return len(frames)
+
+def handle_message_bytes(msg_bytes, client_address):
+    """ Decode one newline delimited JSON message and hand it to process_message """
+    logger.debug(f"Processing message of size {len(msg_bytes)} bytes")
+
+    try:
+        msg_data = json.loads(msg_bytes.decode('utf-8'))
+        logger.debug(f"JSON parsed successfully: {msg_data.get('type', 'unknown')} message")
+
+        process_message(msg_data)
+        logger.debug(f"Message processed successfully")
+
+    except json.JSONDecodeError as je:
+        metrics.record_decode_error()
+        logger.warning(f"Invalid JSON received from {client_address}: {je}, message: {msg_bytes[:100]}...")
+    except Exception as e:
+        metrics.record_decode_error()
+        logger.error(f"Error processing message from {client_address}: {e}")
+
+async def handle_client_async(reader, writer):
+    """ asyncio version of handle_client, one coroutine per connection instead of one thread """
+    client_address = writer.get_extra_info('peername')
+    logger.info(f"Connection established with {client_address}")
+
+    subscriber = Subscriber(SUBSCRIBER_BUFFER)
+    try:
+        buffer = bytearray()
+        protocol = PROTOCOL_JSON
+        while True:
+            try:
+                data = await reader.read(65536)
+            except (ConnectionResetError, ConnectionAbortedError) as e:
+                logger.error(f"Connection lost with {client_address}: {e}")
+                break
+
+            if not data:
+                logger.info(f"Client {client_address} closed connection (empty data)")
+                break
+
+            logger.debug(f"Received {len(data)} bytes from {client_address}")
+            buffer += data
+
+            # process complete messages on the event loop, the queue puts don't wait (see serve_async), a full queue
+            # costs a buffered append to the spool file instead
+            protocol, reply = consume_buffer(buffer, protocol, client_address, subscriber)
+            if reply:
+                writer.write(reply)
+                await writer.drain()
+
+            # every push happens on the event loop (consume_buffer), so an asyncio.Event can wake the sender
+            if subscriber.wakeup is None and (subscriber.keys or subscriber.updates):
+                wake = asyncio.Event()
+                subscriber.wakeup = wake.set
+                asyncio.create_task(send_updates_async(writer, subscriber, wake, client_address))
+                wake.set()
+
+    except Exception as e:
+        logger.error(f"Error handling client {client_address}: {e}")
+    finally:
+        live_cache.close(subscriber)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+        metrics.connection_closed(client_address)
+        logger.info(f"Connection closed with {client_address}")
+
+def parse_timestamp(timestamp):
+    """ JSON messages carry an ISO string, or epoch microseconds which skips the ISO parsing """
+    if isinstance(timestamp, int):
+        return WireProtocol.from_epoch_us(timestamp)
+    return datetime.datetime.fromisoformat(timestamp)
+
 def process_message(message):
     """ Process a message and queue it for database insertion """
     msg_type = message.get('type')
@@ -165,19 +595,19 @@ def process_message(message):
         expiry_date = message.get('expiry_date')
         if expiry_date:
             expiry_date = datetime.datetime.fromisoformat(expiry_date).date()
-        timestamp = datetime.datetime.fromisoformat(message.get('timestamp'))
+        timestamp = parse_timestamp(message.get('timestamp'))
         price = message.get('price')
         num_trades = message.get('num_trades', 0)
         bid_volume = message.get('bid_volume', 0)
         ask_volume = message.get('ask_volume', 0)
 
-        db_queue.put((
+        enqueue(
             "insert_raw",
             (contract_id, symbol, expiry_date, timestamp, price, num_trades, bid_volume, ask_volume)
-        ))
+        )
     elif msg_type == 'continuous_data':
         symbol = message.get('symbol')
-        timestamp = datetime.datetime.fromisoformat(message.get('timestamp'))
+        timestamp = parse_timestamp(message.get('timestamp'))
         price = message.get('price')
         volume = message.get('volume', 0)
         num_trades = message.get('num_trades', 0)
@@ -186,15 +616,40 @@ def process_message(message):
         active_contract = message.get('active_contract_id')
         rollover = message.get('rollover_flag', False)
 
-        db_queue.put((
+        enqueue(
             "insert_continuous",
             (symbol, timestamp, price, volume, num_trades, bid_volume, ask_volume, active_contract, rollover)
-        ))
+        )
     else:
+        metrics.record_decode_error()
         logger.warning(f'Unknown message type: {msg_type}')
 
-def start_server(host='0.0.0.0', port=5555):
-    """ Start the TCP server """
+def process_frame(msg_type, body, client_address=None):
+    """ Binary counterpart of process_message, the body already has the table's column order and an epoch timestamp """
+    try:
+        if msg_type == MSG_RAW:
+            enqueue("insert_raw", WireProtocol.decode_raw(body))
+        elif msg_type == MSG_CONTINUOUS:
+            enqueue("insert_continuous", WireProtocol.decode_continuous(body))
+        else:
+            metrics.record_decode_error()
+            logger.warning(f'Unknown frame type {msg_type} from {client_address}')
+    except Exception as e:
+        metrics.record_decode_error()
+        logger.error(f"Error processing frame from {client_address}: {e}")
+
+def start_metrics(port=None, interval=None) -> None:
+    """ Start the metrics endpoint and/or the periodic stats log if they're turned on """
+    port = METRICS_PORT if port is None else port
+    interval = STATS_INTERVAL if interval is None else interval
+
+    if port:
+        metrics.serve('127.0.0.1', port)
+    if interval:
+        metrics.log_periodically(interval)
+
+def start_server(host='0.0.0.0', port=5555, sink=None, **writer_options):
+    """ Start the TCP server, writer_options go to start_writers (num_writers, queue_size, spool_dir, max_rows, ...) """
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
@@ -203,8 +658,7 @@ def start_server(host='0.0.0.0', port=5555):
         server.listen(5)
         logger.info(f'Server listening on {host}:{port}')
 
-        db_worker_thread = threading.Thread(target=db_worker, daemon=True)
-        db_worker_thread.start()
+        start_writers(sink=sink, **writer_options)
 
         while True:
             client_sock, address = server.accept()
@@ -220,10 +674,60 @@ def start_server(host='0.0.0.0', port=5555):
         logger.error(f"Server error: {e}")
     finally:
         server.close()
-            
+
+async def serve_async(host='0.0.0.0', port=5555, sink=None, **writer_options):
+    """ Run the asyncio server, every connection shares one event loop and the database writes run on the writer threads """
+    # a put that waited on a full queue would stall every connection, so a full queue spools straight away
+    start_writers(sink=sink, **dict(writer_options, put_timeout=0))
+
+    server = await asyncio.start_server(handle_client_async, host, port, backlog=1024)
+    logger.info(f'Async server listening on {host}:{port}')
+
+    async with server:
+        await server.serve_forever()
+
+def start_async_server(host='0.0.0.0', port=5555, sink=None, **writer_options):
+    """ Start the asyncio TCP server, writer_options go to start_writers like for start_server """
+    try:
+        asyncio.run(serve_async(host, port, sink, **writer_options))
+    except KeyboardInterrupt:
+        logger.info("Server shutting down")
+    except Exception as e:
+        logger.error(f"Server error: {e}")
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded",
+                        help="threaded = one thread per client, asyncio = every client on one event loop")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--batch-rows", type=int, default=DB_BATCH_MAX_ROWS, help="Max queued items the db worker writes per flush")
+    parser.add_argument("--batch-latency", type=float, default=DB_BATCH_MAX_LATENCY,
+                        help="Max seconds an item waits in the db worker before a flush")
+    parser.add_argument("--queue-size", type=int, default=DB_QUEUE_SIZE, help="Items each writer holds in memory before spooling to disk")
+    parser.add_argument("--spool-dir", default=SPOOL_DIR, help="Directory for the overflow spool files")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="Serve stats at http://127.0.0.1:<port>/metrics, 0 = off")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL, help="Log the stats every N seconds, 0 = off")
+    parser.add_argument("--writers", type=int, default=DB_WRITERS, help="Number of database writer threads/connections")
+
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
+    args = parse_args()
+    writer_options = {
+        'num_writers': args.writers,
+        'queue_size': args.queue_size,
+        'spool_dir': args.spool_dir,
+        'max_rows': args.batch_rows,
+        'max_latency': args.batch_latency,
+    }
+
+    # double check the db connection
+    if DB_CREATED == 'false':
+        DatabaseUtility.create_db(DB_NAME, DB_USER, DB_PW)
+        DatabaseUtility.create_tables(DB_NAME, DB_USER, DB_PW, partitioned=DB_PARTITIONED)
+        sys.exit("Attempted to create database and tables, doublecheck...")
         
     while True:
         try:
@@ -232,5 +736,11 @@ if __name__ == '__main__':
             break
         except:
             logger.info("Waiting for database connection...")
-            time.sleep()
-    start_server()
+            time.sleep(1)
+
+    start_metrics(args.metrics_port, args.stats_interval)
+
+    if args.mode == "asyncio":
+        start_async_server(args.host, args.port, **writer_options)
+    else:
+        start_server(args.host, args.port, **writer_options)
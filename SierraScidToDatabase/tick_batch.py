@@ -0,0 +1,167 @@
+"""
+Columnar batches of decoded messages for the market data server
+
+A socket read usually holds many messages, instead of decoding and queueing them one at a time the server decodes the
+whole chunk at once (one json.loads for every complete line, or every complete binary frame) into one TickBatch per
+table, with the values held as columns in the table's column order
+The writers get one queue item per batch and hand the rows straight to execute_values
+"""
+import json
+import zlib
+import datetime
+from operator import itemgetter
+from wire_protocol import WireProtocol, MSG_RAW, MSG_CONTINUOUS
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# message type -> (queue operation, fields in table column order with their defaults)
+JSON_LAYOUTS = {
+    "raw_data": ("insert_raw", (
+        ("contract_id", None), ("symbol", None), ("expiry_date", None), ("timestamp", None),
+        ("price", None), ("num_trades", 0), ("bid_volume", 0), ("ask_volume", 0),
+    )),
+    "continuous_data": ("insert_continuous", (
+        ("symbol", None), ("timestamp", None), ("price", None), ("volume", 0), ("num_trades", 0),
+        ("bid_volume", 0), ("ask_volume", 0), ("active_contract_id", None), ("rollover_flag", False),
+    )),
+}
+FRAME_OPERATIONS = {
+    MSG_RAW: ("insert_raw", WireProtocol.decode_raw),
+    MSG_CONTINUOUS: ("insert_continuous", WireProtocol.decode_continuous),
+}
+
+# column that holds the symbol for each operation (the key every row is partitioned on is always column 0)
+SYMBOL_COLUMN = {"insert_raw": 1, "insert_continuous": 0}
+
+
+def partition_of(key, num_partitions: int) -> int:
+    """ Writer a key (contract_id/symbol) belongs to, stable across runs unlike hash() """
+    return zlib.crc32(str(key).encode('utf-8')) % num_partitions
+
+
+def parse_timestamps(values) -> list:
+    """
+    ISO strings or epoch microsecond ints into datetimes, a column of only ints (the usual case for fast clients)
+    skips the type check per value
+    """
+    if all(type(value) is int for value in values):
+        return [EPOCH + datetime.timedelta(microseconds=value) for value in values]
+    if all(type(value) is str for value in values):
+        return list(map(datetime.datetime.fromisoformat, values))
+
+    return [
+        EPOCH + datetime.timedelta(microseconds=value) if isinstance(value, int) else datetime.datetime.fromisoformat(value)
+        for value in values
+    ]
+
+
+class TickBatch:
+    __slots__ = ("operation", "columns", "num_rows")
+
+    def __init__(self, operation: str, columns: list):
+        self.operation = operation
+        self.columns = columns
+        self.num_rows = len(columns[0]) if columns else 0
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def rows(self):
+        """ The batch as row tuples, what execute_values takes """
+        return zip(*self.columns)
+
+    def symbols(self) -> list:
+        return self.columns[SYMBOL_COLUMN[self.operation]]
+
+    def partition(self, num_partitions: int) -> dict:
+        """
+        This function splits the batch by writer ({partition: TickBatch}), rows keep their order within each part
+        A connection usually only sends a few contracts so most batches go to one writer whole
+        """
+        keys = self.columns[0]
+        partitions = {key: partition_of(key, num_partitions) for key in set(keys)}
+        if len(set(partitions.values())) == 1:
+            return {next(iter(partitions.values())): self}
+
+        row_partitions = [partitions[key] for key in keys]
+        parts = {}
+        for part in set(row_partitions):
+            index = [i for i, row_part in enumerate(row_partitions) if row_part == part]
+            pick = itemgetter(*index)
+            columns = [list(pick(column)) if len(index) > 1 else [column[index[0]]] for column in self.columns]
+            parts[part] = TickBatch(self.operation, columns)
+
+        return parts
+
+    @classmethod
+    def from_messages(cls, messages: list) -> tuple:
+        """
+        This function turns decoded JSON messages into one TickBatch per message type
+        Returns (batches, number of messages that weren't a known type)
+        """
+        by_type = {}
+        for message in messages:
+            msg_type = message.get('type') if isinstance(message, dict) else None
+            by_type.setdefault(msg_type, []).append(message)
+
+        batches = []
+        for msg_type, typed in by_type.items():
+            if msg_type not in JSON_LAYOUTS:
+                continue
+
+            operation, fields = JSON_LAYOUTS[msg_type]
+            columns = []
+            for name, default in fields:
+                column = [message.get(name, default) for message in typed]
+                if name == "timestamp":
+                    column = parse_timestamps(column)
+                elif name == "expiry_date":
+                    expiries = {value: datetime.datetime.fromisoformat(value).date() for value in set(column) if value}
+                    column = [expiries.get(value) for value in column]
+                columns.append(column)
+            batches.append(cls(operation, columns))
+
+        unknown = sum(len(typed) for msg_type, typed in by_type.items() if msg_type not in JSON_LAYOUTS)
+        return batches, unknown
+
+    @classmethod
+    def from_json_lines(cls, lines: list) -> tuple:
+        """
+        This function decodes newline delimited JSON messages (without the newlines) in one json.loads call,
+        if the chunk has a bad line it falls back to decoding line by line and skips the bad ones
+        Returns (batches, number of lines that couldn't be decoded or had an unknown type)
+        """
+        bad = 0
+        try:
+            messages = json.loads(b"[" + b",".join(lines) + b"]")
+        except ValueError:
+            messages = []
+            for line in lines:
+                try:
+                    messages.append(json.loads(line))
+                except ValueError:
+                    bad += 1
+
+        batches, unknown = cls.from_messages(messages)
+        return batches, bad + unknown
+
+    @classmethod
+    def from_frames(cls, frames: list) -> tuple:
+        """
+        This function decodes binary frames ([(message type, body)] from WireProtocol.split_frames) into batches
+        Returns (batches, number of frames with an unknown type)
+        """
+        rows = {}
+        bad = 0
+        for msg_type, body in frames:
+            if msg_type not in FRAME_OPERATIONS:
+                bad += 1
+                continue
+            rows.setdefault(msg_type, []).append(body)
+
+        batches = []
+        for msg_type, bodies in rows.items():
+            operation, decode = FRAME_OPERATIONS[msg_type]
+            batches.append(cls(operation, [list(column) for column in zip(*map(decode, bodies))]))
+
+        return batches, bad
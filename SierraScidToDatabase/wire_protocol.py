@@ -0,0 +1,188 @@
+"""
+Binary framing shared by MarketDataClient and the market data server
+
+A connection starts out as newline delimited JSON, the client can send a hello line asking for "binary"
+and once the server answers with a hello_ack every message after it is a frame:
+
+    <u32 body length><u8 message type><body>
+
+The bodies are fixed struct layouts (little endian) sized to the table columns,
+timestamps are integer microseconds since the unix epoch (UTC) and the expiry is days since the unix epoch
+"""
+import json
+import struct
+import datetime
+
+PROTOCOL_JSON = "json"
+PROTOCOL_BINARY = "binary"
+PROTOCOL_VERSION = 1
+
+MSG_RAW = 1
+MSG_CONTINUOUS = 2
+
+FRAME_HEADER = struct.Struct("<IB")
+
+# contract_id, symbol, expiry (days), timestamp (us), price, num_trades, bid_volume, ask_volume
+RAW_TICK = struct.Struct("<50s20siqdiii")
+
+# symbol, timestamp (us), price, volume, num_trades, bid_volume, ask_volume, active_contract_id, rollover_flag
+CONTINUOUS_TICK = struct.Struct("<20sqdiiii50s?")
+
+NO_EXPIRY = -2 ** 31
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+class WireProtocol:
+
+    @classmethod
+    def hello(cls, protocol: str = PROTOCOL_BINARY) -> bytes:
+        """
+        This function builds the JSON line a client sends right after connecting to ask for a protocol
+        """
+        return (json.dumps({"type": "hello", "protocol": protocol, "version": PROTOCOL_VERSION}) + "\n").encode("utf-8")
+
+    @classmethod
+    def hello_ack(cls, protocol: str) -> bytes:
+        """
+        This function builds the server's answer to a hello, protocol is what the connection uses from now on
+        """
+        return (json.dumps({"type": "hello_ack", "protocol": protocol, "version": PROTOCOL_VERSION}) + "\n").encode("utf-8")
+
+    @classmethod
+    def negotiate(cls, message: dict) -> str:
+        """
+        This function picks the protocol to answer a hello with, anything this side doesn't know stays on JSON
+        """
+        if message.get("protocol") == PROTOCOL_BINARY and message.get("version", PROTOCOL_VERSION) <= PROTOCOL_VERSION:
+            return PROTOCOL_BINARY
+        return PROTOCOL_JSON
+
+    @classmethod
+    def to_epoch_us(cls, timestamp) -> int:
+        """
+        This function turns a datetime, ISO string or epoch microseconds into epoch microseconds
+        Naive datetimes are taken as UTC
+        """
+        if isinstance(timestamp, int):
+            return timestamp
+        if isinstance(timestamp, str):
+            timestamp = datetime.datetime.fromisoformat(timestamp)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+
+        return (timestamp - EPOCH) // datetime.timedelta(microseconds=1)
+
+    @classmethod
+    def from_epoch_us(cls, epoch_us: int) -> datetime.datetime:
+        return EPOCH + datetime.timedelta(microseconds=epoch_us)
+
+    @classmethod
+    def _encode_text(cls, value, size: int) -> bytes:
+        encoded = (value or "").encode("utf-8")
+        if len(encoded) > size:
+            raise ValueError(f"{value!r} is longer than {size} bytes")
+        return encoded
+
+    @classmethod
+    def _expiry_days(cls, expiry_date) -> int:
+        if not expiry_date:
+            return NO_EXPIRY
+        if isinstance(expiry_date, str):
+            expiry_date = datetime.date.fromisoformat(expiry_date[:10])
+        return expiry_date.toordinal() - EPOCH_ORDINAL
+
+    @classmethod
+    def encode_raw(cls, contract_id, symbol, price, timestamp, expiry_date=None, num_trades=0, bid_volume=0, ask_volume=0) -> bytes:
+        """
+        This function packs one raw contract tick into a complete frame
+        """
+        return FRAME_HEADER.pack(RAW_TICK.size, MSG_RAW) + RAW_TICK.pack(
+            cls._encode_text(contract_id, 50),
+            cls._encode_text(symbol, 20),
+            cls._expiry_days(expiry_date),
+            cls.to_epoch_us(timestamp),
+            price,
+            num_trades,
+            bid_volume,
+            ask_volume,
+        )
+
+    @classmethod
+    def encode_continuous(cls, symbol, price, active_contract_id, timestamp, volume=0, num_trades=0,
+                          bid_volume=0, ask_volume=0, rollover_flag=False) -> bytes:
+        """
+        This function packs one continuous contract tick into a complete frame
+        """
+        return FRAME_HEADER.pack(CONTINUOUS_TICK.size, MSG_CONTINUOUS) + CONTINUOUS_TICK.pack(
+            cls._encode_text(symbol, 20),
+            cls.to_epoch_us(timestamp),
+            price,
+            volume,
+            num_trades,
+            bid_volume,
+            ask_volume,
+            cls._encode_text(active_contract_id, 50),
+            rollover_flag,
+        )
+
+    @classmethod
+    def decode_raw(cls, body) -> tuple:
+        """
+        This function unpacks a raw tick body into a raw_contracts row
+        (contract_id, symbol, expiry_date, datetime, price, num_trades, bid_volume, ask_volume)
+        """
+        contract_id, symbol, expiry_days, epoch_us, price, num_trades, bid_volume, ask_volume = RAW_TICK.unpack(body)
+        expiry_date = None if expiry_days == NO_EXPIRY else datetime.date.fromordinal(expiry_days + EPOCH_ORDINAL)
+
+        return (
+            contract_id.rstrip(b"\0").decode("utf-8"),
+            symbol.rstrip(b"\0").decode("utf-8"),
+            expiry_date,
+            cls.from_epoch_us(epoch_us),
+            price,
+            num_trades,
+            bid_volume,
+            ask_volume,
+        )
+
+    @classmethod
+    def decode_continuous(cls, body) -> tuple:
+        """
+        This function unpacks a continuous tick body into a continuous_contracts row
+        (symbol, datetime, price, volume, num_trades, bid_volume, ask_volume, active_contract_id, rollover_flag)
+        """
+        symbol, epoch_us, price, volume, num_trades, bid_volume, ask_volume, active_contract_id, rollover_flag = \
+            CONTINUOUS_TICK.unpack(body)
+
+        return (
+            symbol.rstrip(b"\0").decode("utf-8"),
+            cls.from_epoch_us(epoch_us),
+            price,
+            volume,
+            num_trades,
+            bid_volume,
+            ask_volume,
+            active_contract_id.rstrip(b"\0").decode("utf-8"),
+            rollover_flag,
+        )
+
+    @classmethod
+    def split_frames(cls, buffer) -> tuple:
+        """
+        This function cuts every complete frame off the front of buffer
+        Returns ([(message type, body), ...], leftover bytes of an incomplete frame)
+        """
+        frames = []
+        position = 0
+        header_size = FRAME_HEADER.size
+
+        while len(buffer) - position >= header_size:
+            body_size, msg_type = FRAME_HEADER.unpack_from(buffer, position)
+            end = position + header_size + body_size
+            if end > len(buffer):
+                break
+            frames.append((msg_type, buffer[position + header_size:end]))
+            position = end
+
+        return frames, buffer[position:]